@@ -0,0 +1,176 @@
+"""
+Benchmark suite for idc_helper.py
+
+Runs every idc_helper.py command against a synthetic organisation served by idc_fake_backend.py (no network access
+or AWS credentials needed) and records, per command: wall time, API calls per operation, peak Python memory and rows
+returned. Call counts are deterministic for a given scale and seed, so a saved baseline can be used to catch
+regressions (e.g. in CI).
+
+SYNTAX:
+python idc_benchmark.py [--scale small|medium|large] [OPTIONS]
+
+OPTIONS:
+--scale NAME - Size of the synthetic organisation (default small). large is 1,000 accounts, 3,000 groups, 50,000 users and 200 permission sets.
+--workers N, --rate N - Passed to idc_helper.py (defaults 8 and 1000, so the rate limiter doesn't dominate).
+--latency MS - Latency added to every fake API call (default 0).
+--throttle P - Probability of a fake API call failing with ThrottlingException (default 0).
+--commands NAME,NAME - Only run these commands (default all). The diff cases need pyyaml, and are skipped without it.
+--save PATH - Write the results to a JSON file.
+--baseline PATH - Compare with a saved JSON file and exit non-zero if any command makes more API calls than the
+                  baseline, or takes longer than the baseline by more than --time-tolerance.
+--time-tolerance F - Allowed wall-time slowdown against the baseline, as a fraction (default: don't compare times).
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import idc_fake_backend
+import idc_helper
+
+
+SCALES = {
+    "small": {"accounts": 50, "groups": 100, "users": 1000, "permission_sets": 20},
+    "medium": {"accounts": 300, "groups": 800, "users": 10000, "permission_sets": 60},
+    "large": {"accounts": 1000, "groups": 3000, "users": 50000, "permission_sets": 200},
+}
+
+
+def write_group_definitions(backend, directory):
+    # Group YAML for the diff cases, with some drift from the synthetic assignments. None if pyyaml isn't installed.
+    try:
+        import yaml
+    except ImportError:
+        return None
+    path = os.path.join(directory, "groups")
+    os.makedirs(path)
+    for definition in backend.group_definitions(drift=0.05):
+        with open(os.path.join(path, f"{definition['team']['name']}.yaml"), "w") as f:
+            yaml.safe_dump(definition, f)
+    return path
+
+
+def benchmark_cases(backend, group_definitions=None):
+    # (label, command, option, offline). Options are picked from the synthetic org so every command has real work.
+    accounts = sorted(backend.accounts.values(), key=lambda account: len(backend.provisioned_to_account.get(account["Id"], [])))
+    busiest_account = accounts[-1]["Name"]
+    some_accounts = ",".join(account["Name"] for account in accounts[-5:])
+    groups = sorted(backend.groups.values(), key=lambda group: len(backend.assignments_by_principal.get(group["GroupId"], [])))
+    busiest_group = groups[-1]["DisplayName"]
+    users = sorted(backend.users.values(), key=lambda user: len(backend.memberships.get(user["UserId"], [])))
+    busiest_user = users[-1]["UserName"]
+    two_users = f"{users[-1]['UserName']},{users[-2]['UserName']}"
+    permission_sets = sorted(backend.permission_sets.items(), key=lambda item: len(backend.provisioned.get(item[0], [])))
+    busiest_permission_set = permission_sets[-1][1]["Name"]
+    top_ous = backend.children[backend.root["Id"]]["ORGANIZATIONAL_UNIT"]
+    def descendant_count(ou_id):
+        return len(backend.children[ou_id]["ACCOUNT"]) + sum(descendant_count(child_id) for child_id in backend.children[ou_id]["ORGANIZATIONAL_UNIT"])
+    biggest_ou = backend.ous[max(top_ous, key=descendant_count)]["Name"] if top_ous else backend.root["Name"]
+    cases = [
+        ("list-entitlements", "list-entitlements", None, False),
+        ("list-group-members", "list-group-members", None, False),
+        ("get-groups-for-account", "get-groups-for-account", busiest_account, False),
+        ("get-accounts-for-group", "get-accounts-for-group", busiest_group, False),
+        ("get-permissions-for-user", "get-permissions-for-user", busiest_user, False),
+        ("get-users-for-accounts", "get-users-for-accounts", some_accounts, False),
+        ("get-users-for-accounts-all", "get-users-for-accounts", "all", False),
+        ("get-users-for-ou", "get-users-for-ou", biggest_ou, False),
+        ("get-users-for-action", "get-users-for-action", f"iam:PassRole,{busiest_account}", False),
+        ("refresh", "refresh", None, False),
+        ("get-users-for-accounts-all-offline", "get-users-for-accounts", "all", True),
+        ("get-permissions-for-user-offline", "get-permissions-for-user", busiest_user, True),
+        ("get-users-for-ou-offline", "get-users-for-ou", biggest_ou, True),
+        ("get-users-for-action-offline", "get-users-for-action", "iam:PassRole", True),
+        ("get-users-for-permission-set-offline", "get-users-for-permission-set", busiest_permission_set, True),
+        ("compare-users-offline", "compare-users", two_users, True),
+    ]
+    if group_definitions:
+        cases.insert(cases.index(("refresh", "refresh", None, False)), ("diff", "diff", group_definitions, False))
+        cases.append(("diff-offline", "diff", group_definitions, True))
+    return cases
+
+
+def run_case(backend, store_path, command, option, offline, max_age):
+    # Every case starts from a cold module (no memoised clients, caches or rate limits) and counts only its own calls.
+    idc_helper.reset_state()
+    backend.reset_calls()
+    helper = idc_helper.IdcHelper(store_path, offline=offline)
+    tracemalloc.start()
+    start = time.perf_counter()
+    header, rows = helper.run(command, option, max_age=max_age)
+    row_count = sum(1 for row in rows)
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "wall_time": round(wall_time, 3),
+        "api_calls": sum(backend.calls.values()),
+        "api_calls_by_operation": dict(sorted(backend.calls.items())),
+        "peak_memory_mb": round(peak_memory / 2**20, 1),
+        "rows": row_count,
+    }
+
+
+def compare(results, baseline, time_tolerance):
+    # Returns a list of regressions against the baseline results.
+    regressions = []
+    for label, result in results["commands"].items():
+        previous = baseline.get("commands", {}).get(label)
+        if previous is None:
+            continue
+        if result["api_calls"] > previous["api_calls"]:
+            regressions.append(f"{label}: {result['api_calls']} API calls (baseline {previous['api_calls']}).")
+        if time_tolerance is not None and result["wall_time"] > previous["wall_time"] * (1 + time_tolerance):
+            regressions.append(f"{label}: {result['wall_time']}s (baseline {previous['wall_time']}s).")
+        if result["rows"] != previous["rows"]:
+            regressions.append(f"{label}: {result['rows']} rows (baseline {previous['rows']}).")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(usage="python idc_benchmark.py [--scale small|medium|large] [OPTIONS]")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=1000.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--throttle", type=float, default=0.0)
+    parser.add_argument("--commands")
+    parser.add_argument("--save")
+    parser.add_argument("--baseline")
+    parser.add_argument("--time-tolerance", type=float)
+    args = parser.parse_args()
+    idc_helper.logger.setLevel(logging.ERROR)
+
+    backend = idc_fake_backend.FakeBackend(**SCALES[args.scale], seed=args.seed, latency=args.latency / 1000, throttle_rate=args.throttle)
+    idc_helper.set_session(idc_fake_backend.FakeSession(backend))
+    idc_helper.configure_concurrency(args.workers, args.rate)
+    print(f"Synthetic org ({args.scale}): {backend.summary()}")
+
+    results = {"scale": args.scale, "seed": args.seed, "workers": args.workers, "org": backend.summary(), "commands": {}}
+    selected = args.commands.split(",") if args.commands else None
+    print(f"{'command':<38}{'wall s':>9}{'API calls':>11}{'peak MB':>9}{'rows':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        store_path = os.path.join(directory, "idc_helper.db")
+        for label, command, option, offline in benchmark_cases(backend, write_group_definitions(backend, directory)):
+            if selected and label not in selected:
+                continue
+            result = run_case(backend, store_path, command, option, offline, max_age=0)
+            results["commands"][label] = result
+            print(f"{label:<38}{result['wall_time']:>9}{result['api_calls']:>11}{result['peak_memory_mb']:>9}{result['rows']:>10}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.time_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,407 @@
+"""
+Local stand-in for the AWS APIs used by idc_helper.py
+
+Implements the identitystore, sso-admin, organizations and iam operations that idc_helper.py calls, over a synthetic
+organisation held in memory. Responses are paginated like the real APIs (same MaxResults limits, opaque NextToken)
+and are deterministic for a given seed. Throttling (ThrottlingException) and per-call latency can be injected, and
+every call is counted per operation.
+
+USAGE:
+import idc_fake_backend, idc_helper
+backend = idc_fake_backend.FakeBackend(accounts=1000, groups=3000, users=50000, permission_sets=200)
+idc_helper.set_session(idc_fake_backend.FakeSession(backend))
+
+See idc_benchmark.py for the benchmark suite built on top of it.
+"""
+
+import json
+import random
+import threading
+import time
+import types
+from collections import Counter, defaultdict
+
+import botocore.exceptions
+
+
+class ResourceNotFoundException(botocore.exceptions.ClientError):
+
+    def __init__(self, operation_name, message):
+        super().__init__({"Error": {"Code": "ResourceNotFoundException", "Message": message}}, operation_name)
+
+
+class FakeBackend:
+    # A synthetic organisation: OU tree, accounts, permission sets, groups, users, memberships and assignments.
+
+    INSTANCE_ARN = "arn:aws:sso:::instance/ssoins-0000000000000000"
+    IDENTITY_STORE_ID = "d-0000000000"
+    # A few AWS-managed policies (statements abridged), covering wildcard and NotAction grants.
+    MANAGED_POLICIES = {
+        "AdministratorAccess": [{"Effect": "Allow", "Action": "*", "Resource": "*"}],
+        "ReadOnlyAccess": [{"Effect": "Allow", "Action": ["*:Describe*", "*:Get*", "*:List*"], "Resource": "*"}],
+        "PowerUserAccess": [
+            {"Effect": "Allow", "NotAction": ["iam:*", "organizations:*", "account:*"], "Resource": "*"},
+            {"Effect": "Allow", "Action": ["iam:CreateServiceLinkedRole", "iam:DeleteServiceLinkedRole", "iam:ListRoles", "organizations:DescribeOrganization"], "Resource": "*"},
+        ],
+        "IAMFullAccess": [{"Effect": "Allow", "Action": ["iam:*", "organizations:DescribeAccount", "organizations:DescribeOrganization"], "Resource": "*"}],
+        "AmazonS3FullAccess": [{"Effect": "Allow", "Action": ["s3:*", "s3-object-lambda:*"], "Resource": "*"}],
+        "AmazonEC2ReadOnlyAccess": [{"Effect": "Allow", "Action": ["ec2:Describe*", "elasticloadbalancing:Describe*", "cloudwatch:Get*"], "Resource": "*"}],
+        "AWSLambda_FullAccess": [
+            {"Effect": "Allow", "Action": ["lambda:*", "logs:DescribeLogGroups", "iam:ListRoles"], "Resource": "*"},
+            {"Effect": "Allow", "Action": "iam:PassRole", "Resource": "*", "Condition": {"StringEquals": {"iam:PassedToService": "lambda.amazonaws.com"}}},
+        ],
+    }
+
+    def __init__(self, accounts=50, groups=100, users=1000, permission_sets=20, seed=0, latency=0.0, throttle_rate=0.0):
+        self.latency = latency # Seconds added to every call.
+        self.throttle_rate = throttle_rate # Probability of a call failing with ThrottlingException.
+        self.calls = Counter() # {operation: calls}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.generate(accounts, groups, users, permission_sets)
+
+    def generate(self, account_count, group_count, user_count, permission_set_count):
+        rng = random.Random(self.random.random())
+
+        ## Organisation: a root, OUs nested up to three deep, accounts spread across them (a few suspended).
+        self.root = {"Id": "r-0000", "Name": "Root"}
+        self.ous = {}
+        self.children = defaultdict(lambda: {"ORGANIZATIONAL_UNIT": [], "ACCOUNT": []})
+        parents = [(self.root["Id"], 0)]
+        for i in range(max(1, account_count // 20)):
+            parent_id, depth = rng.choice([parent for parent in parents if parent[1] < 3])
+            ou_id = f"ou-0000-{i:08x}"
+            self.ous[ou_id] = {"Id": ou_id, "Arn": f"arn:aws:organizations:::ou/{ou_id}", "Name": f"OU-{i:03d}"}
+            self.children[parent_id]["ORGANIZATIONAL_UNIT"].append(ou_id)
+            parents.append((ou_id, depth + 1))
+        self.accounts = {}
+        for i in range(account_count):
+            account_id = f"{100000000000 + i}"
+            self.accounts[account_id] = {
+                "Id": account_id,
+                "Arn": f"arn:aws:organizations:::account/{account_id}",
+                "Email": f"aws+account-{i:04d}@example.com",
+                "Name": f"account-{i:04d}",
+                "Status": "SUSPENDED" if rng.random() < 0.05 else "ACTIVE",
+            }
+            self.children[rng.choice(parents)[0]]["ACCOUNT"].append(account_id)
+
+        ## Permission sets
+        self.permission_sets = {}
+        for i in range(permission_set_count):
+            arn = f"{self.INSTANCE_ARN.replace(':instance/', ':permissionSet/')}/ps-{i:016x}"
+            self.permission_sets[arn] = {
+                "PermissionSetArn": arn,
+                "Name": f"PermissionSet{i:03d}",
+                "Description": f"Permission set {i}",
+                "SessionDuration": "PT1H",
+            }
+
+        ## Users and groups. Group names follow the group module's team_role convention; some descriptions have commas.
+        self.users = {}
+        for i in range(user_count):
+            user_id = f"u-{i:08x}-0000-0000-0000-000000000000"
+            self.users[user_id] = {
+                "UserId": user_id,
+                "UserName": f"user{i:05d}@example.com",
+                "DisplayName": f"User {i:05d}",
+                "IdentityStoreId": self.IDENTITY_STORE_ID,
+            }
+        self.groups = {}
+        for i in range(group_count):
+            group_id = f"g-{i:08x}-0000-0000-0000-000000000000"
+            self.groups[group_id] = {"GroupId": group_id, "DisplayName": f"team{i // 3:04d}_role{i % 3}", "IdentityStoreId": self.IDENTITY_STORE_ID}
+            if i % 4:
+                self.groups[group_id]["Description"] = f"Team {i // 3}, role {i % 3}" if i % 4 == 1 else f"Team {i // 3} role {i % 3}"
+        group_ids = list(self.groups)
+        user_ids = list(self.users)
+        self.members = defaultdict(list) # {GroupId: [UserId]}
+        self.memberships = defaultdict(list) # {UserId: [GroupId]}
+        for user_id in user_ids:
+            for group_id in rng.sample(group_ids, min(len(group_ids), rng.randint(1, 4))) if group_ids else []:
+                self.members[group_id].append(user_id)
+                self.memberships[user_id].append(group_id)
+
+        ## Assignments: each group gets a few permission sets on a few accounts; about 1% are platform groups on a third
+        ## of the org. A sprinkling of direct user assignments, including one for a user that no longer exists.
+        account_ids = list(self.accounts)
+        permission_set_arns = list(self.permission_sets)
+        assignments = set()
+        if account_ids and permission_set_arns:
+            for group_id in group_ids:
+                platform = rng.random() < 0.01
+                for arn in rng.sample(permission_set_arns, min(len(permission_set_arns), rng.randint(1, 3))):
+                    for account_id in rng.sample(account_ids, max(1, len(account_ids) // 3) if platform else min(len(account_ids), rng.randint(1, 8))):
+                        assignments.add((arn, account_id, "GROUP", group_id))
+            for user_id in rng.sample(user_ids, min(len(user_ids), max(1, len(user_ids) // 200))):
+                assignments.add((rng.choice(permission_set_arns), rng.choice(account_ids), "USER", user_id))
+            assignments.add((permission_set_arns[0], account_ids[0], "USER", "u-deleted-0000-0000-0000-000000000000"))
+        self.assignments = defaultdict(list) # {(PermissionSetArn, AccountId): [assignment]}
+        self.assignments_by_principal = defaultdict(list)
+        self.provisioned = defaultdict(list) # {PermissionSetArn: [AccountId]}
+        self.provisioned_to_account = defaultdict(list) # {AccountId: [PermissionSetArn]}
+        for arn, account_id, principal_type, principal_id in sorted(assignments):
+            assignment = {"AccountId": account_id, "PermissionSetArn": arn, "PrincipalType": principal_type, "PrincipalId": principal_id}
+            if not self.assignments[(arn, account_id)]:
+                self.provisioned[arn].append(account_id)
+                self.provisioned_to_account[account_id].append(arn)
+            self.assignments[(arn, account_id)].append(assignment)
+            self.assignments_by_principal[principal_id].append(assignment)
+        # About 2% of the provisioned permission sets were changed and not re-provisioned since.
+        self.outdated = {pair for pair in sorted(self.assignments) if rng.random() < 0.02} # {(PermissionSetArn, AccountId)}
+
+        ## Policies, as the permission-set module attaches them: up to two AWS-managed policies, an inline policy on
+        ## about half (some passing roles, some with a Deny) and a customer-managed policy reference on about 10%.
+        self.managed_policy_attachments = {} # {PermissionSetArn: [policy name]}
+        self.inline_policies = {} # {PermissionSetArn: policy document}
+        self.customer_managed_policy_references = {} # {PermissionSetArn: [{Name, Path}]}
+        for i, arn in enumerate(permission_set_arns):
+            self.managed_policy_attachments[arn] = rng.sample(sorted(self.MANAGED_POLICIES), rng.randint(0, 2))
+            if rng.random() < 0.5:
+                statements = [{"Effect": "Allow", "Action": rng.choice([["iam:PassRole", "iam:GetRole"], ["sqs:*", "sns:Publish"], "dynamodb:Query"]), "Resource": f"arn:aws:iam::*:role/app-{i}-*"}]
+                if rng.random() < 0.3:
+                    statements.append({"Effect": "Deny", "Action": rng.choice(["iam:PassRole", "s3:DeleteBucket", "iam:*"]), "Resource": "*"})
+                self.inline_policies[arn] = {"Version": "2012-10-17", "Statement": statements}
+            if rng.random() < 0.1:
+                self.customer_managed_policy_references[arn] = [{"Name": f"team-boundary-{i}", "Path": "/"}]
+
+    def group_definitions(self, drift=0.0):
+        # Group module YAML documents ({team, roles, account_sets}) reproducing the synthetic GROUP assignments, one
+        # account set per role and permission set. With drift, that fraction of the account sets gain an account
+        # without an assignment (a missing entitlement) or lose one that has one (an extra entitlement).
+        rng = random.Random(self.random.random())
+        teams = defaultdict(lambda: defaultdict(lambda: defaultdict(list))) # {team: {role: {permission set name: [account name]}}}
+        for (arn, account_id), assignments in sorted(self.assignments.items()):
+            for assignment in assignments:
+                if assignment["PrincipalType"] == "GROUP":
+                    team, role = self.groups[assignment["PrincipalId"]]["DisplayName"].split("_", 1)
+                    teams[team][role][self.permission_sets[arn]["Name"]].append(self.accounts[account_id]["Name"])
+        account_names = sorted(account["Name"] for account in self.accounts.values())
+        definitions = []
+        for team, roles in sorted(teams.items()):
+            definition = {"team": {"name": team}, "roles": [], "account_sets": []}
+            for role, permission_sets in sorted(roles.items()):
+                role_definition = {"name": role, "permission_sets": []}
+                for permission_set_name, accounts in sorted(permission_sets.items()):
+                    account_set = f"{role}_{permission_set_name}"
+                    if rng.random() < drift / 2:
+                        accounts = accounts + [rng.choice([name for name in account_names if name not in accounts])]
+                    elif rng.random() < drift / 2 and len(accounts) > 1:
+                        accounts = accounts[1:]
+                    definition["account_sets"].append({"name": account_set, "accounts": accounts})
+                    role_definition["permission_sets"].append({"name": permission_set_name, "account_sets": [account_set]})
+                definition["roles"].append(role_definition)
+            definitions.append(definition)
+        return definitions
+
+    def call(self, operation):
+        # Count the call, wait out the injected latency and maybe throttle it.
+        with self.lock:
+            self.calls[operation] += 1
+            throttled = self.random.random() < self.throttle_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, operation)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = Counter()
+
+    def summary(self):
+        return {
+            "accounts": len(self.accounts),
+            "ous": len(self.ous),
+            "permission_sets": len(self.permission_sets),
+            "groups": len(self.groups),
+            "users": len(self.users),
+            "memberships": sum(len(members) for members in self.members.values()),
+            "assignments": sum(len(assignments) for assignments in self.assignments.values()),
+        }
+
+
+def paginate(items, key, NextToken=None, MaxResults=100, limit=100):
+    if MaxResults > limit:
+        raise botocore.exceptions.ParamValidationError(report=f"MaxResults must be at most {limit}.")
+    start = int(NextToken) if NextToken else 0
+    page = {key: items[start:start + MaxResults]}
+    if start + MaxResults < len(items):
+        page["NextToken"] = str(start + MaxResults)
+    return page
+
+
+class FakeClient:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.exceptions = types.SimpleNamespace(ResourceNotFoundException=ResourceNotFoundException)
+
+
+class FakeSsoAdmin(FakeClient):
+
+    def list_instances(self, **kwargs):
+        self.backend.call("list_instances")
+        return {"Instances": [{"InstanceArn": self.backend.INSTANCE_ARN, "IdentityStoreId": self.backend.IDENTITY_STORE_ID}]}
+
+    def list_permission_sets(self, InstanceArn, MaxResults=100, NextToken=None):
+        self.backend.call("list_permission_sets")
+        return paginate(list(self.backend.permission_sets), "PermissionSets", NextToken, MaxResults)
+
+    def describe_permission_set(self, InstanceArn, PermissionSetArn):
+        self.backend.call("describe_permission_set")
+        if PermissionSetArn not in self.backend.permission_sets:
+            raise ResourceNotFoundException("DescribePermissionSet", "Permission set not found")
+        return {"PermissionSet": dict(self.backend.permission_sets[PermissionSetArn])}
+
+    def list_accounts_for_provisioned_permission_set(self, InstanceArn, PermissionSetArn, MaxResults=100, NextToken=None, ProvisioningStatus=None):
+        self.backend.call("list_accounts_for_provisioned_permission_set")
+        account_ids = self.backend.provisioned.get(PermissionSetArn, [])
+        if ProvisioningStatus:
+            outdated = ProvisioningStatus == "LATEST_PERMISSION_SET_NOT_PROVISIONED"
+            account_ids = [account_id for account_id in account_ids if ((PermissionSetArn, account_id) in self.backend.outdated) == outdated]
+        return paginate(account_ids, "AccountIds", NextToken, MaxResults)
+
+    def list_permission_sets_provisioned_to_account(self, InstanceArn, AccountId, MaxResults=100, NextToken=None, **kwargs):
+        self.backend.call("list_permission_sets_provisioned_to_account")
+        return paginate(self.backend.provisioned_to_account.get(AccountId, []), "PermissionSets", NextToken, MaxResults)
+
+    def list_account_assignments(self, InstanceArn, AccountId, PermissionSetArn, MaxResults=100, NextToken=None):
+        self.backend.call("list_account_assignments")
+        return paginate(self.backend.assignments.get((PermissionSetArn, AccountId), []), "AccountAssignments", NextToken, MaxResults)
+
+    def list_managed_policies_in_permission_set(self, InstanceArn, PermissionSetArn, MaxResults=100, NextToken=None):
+        self.backend.call("list_managed_policies_in_permission_set")
+        policies = [{"Name": name, "Arn": f"arn:aws:iam::aws:policy/{name}"} for name in self.backend.managed_policy_attachments.get(PermissionSetArn, [])]
+        return paginate(policies, "AttachedManagedPolicies", NextToken, MaxResults)
+
+    def get_inline_policy_for_permission_set(self, InstanceArn, PermissionSetArn):
+        self.backend.call("get_inline_policy_for_permission_set")
+        policy = self.backend.inline_policies.get(PermissionSetArn)
+        return {"InlinePolicy": json.dumps(policy) if policy else ""}
+
+    def list_customer_managed_policy_references_in_permission_set(self, InstanceArn, PermissionSetArn, MaxResults=100, NextToken=None):
+        self.backend.call("list_customer_managed_policy_references_in_permission_set")
+        return paginate(self.backend.customer_managed_policy_references.get(PermissionSetArn, []), "CustomerManagedPolicyReferences", NextToken, MaxResults)
+
+    def list_account_assignments_for_principal(self, InstanceArn, PrincipalId, PrincipalType, MaxResults=100, NextToken=None, **kwargs):
+        # Like the real API, a user's assignments include the ones inherited through its groups.
+        self.backend.call("list_account_assignments_for_principal")
+        principal_ids = [PrincipalId] + (self.backend.memberships.get(PrincipalId, []) if PrincipalType == "USER" else [])
+        assignments = [assignment for principal_id in principal_ids for assignment in self.backend.assignments_by_principal.get(principal_id, [])]
+        return paginate(assignments, "AccountAssignments", NextToken, MaxResults)
+
+
+class FakeIdentityStore(FakeClient):
+
+    @staticmethod
+    def filtered(items, Filters, attributes):
+        for attribute_filter in Filters or []:
+            if attribute_filter["AttributePath"] not in attributes:
+                raise botocore.exceptions.ParamValidationError(report=f"Unsupported filter {attribute_filter['AttributePath']}.")
+            items = [item for item in items if item.get(attribute_filter["AttributePath"]) == attribute_filter["AttributeValue"]]
+        return items
+
+    def list_groups(self, IdentityStoreId, MaxResults=100, NextToken=None, Filters=None):
+        self.backend.call("list_groups")
+        return paginate(self.filtered(list(self.backend.groups.values()), Filters, ("DisplayName",)), "Groups", NextToken, MaxResults)
+
+    def describe_group(self, IdentityStoreId, GroupId):
+        self.backend.call("describe_group")
+        if GroupId not in self.backend.groups:
+            raise ResourceNotFoundException("DescribeGroup", "Group not found")
+        return dict(self.backend.groups[GroupId])
+
+    def list_group_memberships(self, IdentityStoreId, GroupId, MaxResults=100, NextToken=None):
+        self.backend.call("list_group_memberships")
+        memberships = [{"GroupId": GroupId, "MemberId": {"UserId": user_id}} for user_id in self.backend.members.get(GroupId, [])]
+        return paginate(memberships, "GroupMemberships", NextToken, MaxResults)
+
+    def list_group_memberships_for_member(self, IdentityStoreId, MemberId, MaxResults=100, NextToken=None):
+        self.backend.call("list_group_memberships_for_member")
+        memberships = [{"GroupId": group_id, "MemberId": MemberId} for group_id in self.backend.memberships.get(MemberId["UserId"], [])]
+        return paginate(memberships, "GroupMemberships", NextToken, MaxResults)
+
+    def list_users(self, IdentityStoreId, MaxResults=100, NextToken=None, Filters=None):
+        self.backend.call("list_users")
+        return paginate(self.filtered(list(self.backend.users.values()), Filters, ("UserName",)), "Users", NextToken, MaxResults)
+
+    def describe_user(self, IdentityStoreId, UserId):
+        self.backend.call("describe_user")
+        if UserId not in self.backend.users:
+            raise ResourceNotFoundException("DescribeUser", "User not found")
+        return dict(self.backend.users[UserId])
+
+
+class FakeOrganizations(FakeClient):
+
+    def list_accounts(self, MaxResults=20, NextToken=None):
+        self.backend.call("list_accounts")
+        return paginate(list(self.backend.accounts.values()), "Accounts", NextToken, MaxResults, limit=20)
+
+    def describe_account(self, AccountId):
+        self.backend.call("describe_account")
+        if AccountId not in self.backend.accounts:
+            raise ResourceNotFoundException("DescribeAccount", "Account not found")
+        return {"Account": dict(self.backend.accounts[AccountId])}
+
+    def list_roots(self, **kwargs):
+        self.backend.call("list_roots")
+        return {"Roots": [dict(self.backend.root)]}
+
+    def list_children(self, ParentId, ChildType, MaxResults=20, NextToken=None):
+        self.backend.call("list_children")
+        children = [{"Id": child_id, "Type": ChildType} for child_id in self.backend.children[ParentId][ChildType]]
+        return paginate(children, "Children", NextToken, MaxResults, limit=20)
+
+    def list_organizational_units_for_parent(self, ParentId, MaxResults=20, NextToken=None):
+        self.backend.call("list_organizational_units_for_parent")
+        ous = [dict(self.backend.ous[ou_id]) for ou_id in self.backend.children[ParentId]["ORGANIZATIONAL_UNIT"]]
+        return paginate(ous, "OrganizationalUnits", NextToken, MaxResults, limit=20)
+
+    def list_accounts_for_parent(self, ParentId, MaxResults=20, NextToken=None):
+        self.backend.call("list_accounts_for_parent")
+        accounts = [dict(self.backend.accounts[account_id]) for account_id in self.backend.children[ParentId]["ACCOUNT"]]
+        return paginate(accounts, "Accounts", NextToken, MaxResults, limit=20)
+
+    def describe_organizational_unit(self, OrganizationalUnitId):
+        self.backend.call("describe_organizational_unit")
+        if OrganizationalUnitId not in self.backend.ous:
+            raise ResourceNotFoundException("DescribeOrganizationalUnit", "OU not found")
+        return {"OrganizationalUnit": dict(self.backend.ous[OrganizationalUnitId])}
+
+
+class NoSuchEntityException(botocore.exceptions.ClientError):
+
+    def __init__(self, operation_name, message):
+        super().__init__({"Error": {"Code": "NoSuchEntity", "Message": message}}, operation_name)
+
+
+class FakeIam(FakeClient):
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.exceptions = types.SimpleNamespace(NoSuchEntityException=NoSuchEntityException)
+
+    def get_policy(self, PolicyArn):
+        self.backend.call("get_policy")
+        name = PolicyArn.rpartition("/")[2]
+        if name not in self.backend.MANAGED_POLICIES:
+            raise NoSuchEntityException("GetPolicy", "Policy not found")
+        return {"Policy": {"PolicyName": name, "Arn": PolicyArn, "DefaultVersionId": "v1"}}
+
+    def get_policy_version(self, PolicyArn, VersionId):
+        self.backend.call("get_policy_version")
+        statements = self.backend.MANAGED_POLICIES[PolicyArn.rpartition("/")[2]]
+        return {"PolicyVersion": {"Document": {"Version": "2012-10-17", "Statement": statements}, "VersionId": VersionId, "IsDefaultVersion": True}}
+
+
+class FakeSession:
+    # Drop-in for boto3.Session: idc_helper.set_session(FakeSession(backend)).
+
+    CLIENTS = {"sso-admin": FakeSsoAdmin, "identitystore": FakeIdentityStore, "organizations": FakeOrganizations, "iam": FakeIam}
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def client(self, service_name, **kwargs):
+        return self.CLIENTS[service_name](self.backend)
@@ -2,217 +2,796 @@
 Helper script for AWS Identity Centre
 
 This script provides information that's difficult to obtain from the IDC console (without a lot of clicking around) and cannot be exported.
-All commands log to the console and write to CSV (idc_helper.csv).
+All commands log to the console and write a report (idc_helper.csv by default, see --output and --format). Rows are written as they are produced.
+Commands are answered from an in-memory snapshot built with the list APIs (see Snapshot), rather than per-row describe_* calls.
 
 SYNTAX:
-python idc_helper.py COMMAND [OPTION]
+python idc_helper.py COMMAND [OPTION] [--workers N] [--rate N] [--cache-size N] [--cache-ttl SECONDS] [--store PATH] [--offline] [--max-age SECONDS] [--metrics PATH] [--progress SECONDS] [--output PATH] [--format FORMAT] [--ou-map PATH] [--refresh-every SECONDS] [--shard I/N] [--shard-by permission-set|account]
+
+--workers N - Fan API calls out over N concurrent workers (default 1).
+--rate N - Maximum requests per second for each API operation (default 10). Throttled calls, and transient errors (5xx responses, network failures), back off with jitter and retry automatically.
+--cache-size N - Maximum entries held by each describe_* resolver cache (default 10000).
+--cache-ttl SECONDS - Seconds before a cached describe_* lookup expires (default 3600). Cache statistics are logged at the end of each run.
+--store PATH - SQLite snapshot store that every crawl is written into (default idc_helper.db).
+--offline - Answer the command from the snapshot store without calling AWS. The age of the data is logged.
+--max-age SECONDS - Entities captured longer ago than this are re-crawled by refresh (default 86400).
+--metrics PATH - Write per-operation API metrics (calls, pages, latency histogram, retries, throttles, errors) and rows emitted to PATH at the end of the run. A Prometheus textfile if PATH ends in .prom, JSON otherwise.
+--progress SECONDS - Log a progress line (current crawl stage, estimated time remaining, API calls so far) every SECONDS.
+--output PATH - Write the report to PATH (default idc_helper.csv, or idc_helper.FORMAT), or to stdout if PATH is -. Log lines go to stderr, so stdout can be piped.
+--format FORMAT - Report format: csv (default), csv.gz, csv.zst, jsonl, parquet or arrow. csv.zst needs the zstandard package, parquet and arrow need pyarrow.
+                  Parquet / Arrow dictionary-encode the account, permission set and group columns. Every format but csv starts with (or, for
+                  Parquet / Arrow, stores in the schema metadata) the command and the time the data was captured.
+--ou-map PATH - For diff: the org module's org_ou_account_map output as JSON. Without it the organisation's OU tree is crawled (breadth first, each level concurrently).
+--refresh-every SECONDS - For serve: seconds between background refreshes of the daemon's data (default 900).
+--shard I/N - For refresh: crawl only shard I (0 to N-1) of N into --store, so a crawl can be split over N processes or hosts and combined with merge.
+--shard-by permission-set|account - Split the permission set / account pairs between shards by permission set (default) or by account.
 
 COMMANDS:
-list-entitlements - Fully expands all 'Entitlements' (accounts, permission sets, users / groups).
+list-entitlements - Fully expands all 'Entitlements' (accounts, permission sets, users / groups). The crawl is checkpointed in the --store: if a run is interrupted
+                    (e.g. an expired SSO token), the next run resumes where it stopped and writes the complete report. Checkpoints older than --max-age are discarded.
 list-group-members - Provides a list of all groups and the group members.
-get-groups-for-account - OPTION required here is an account name / alias. Lists all groups that can access the account (and the permission sets).
+get-groups-for-account - OPTION required here is an account name / alias / ID (or a comma-separated list - no spaces). Lists all groups that can access the account(s) (and the permission sets).
 get-accounts-for-group - OPTION required here is a group name. Lists all accounts that can be accessed by members of the group (and the permission sets).
 get-permissions-for-user - OPTION required here is a username. Lists all accounts a user can access (with permission set) and whether direct or via a group.
-get-users-for-accounts - OPTION required here is an account name / alias (or a comma-separated list - no spaces). Shows all users who can access the account, and via group or direct access.
+get-users-for-accounts - OPTION required here is an account name / alias / ID (or a comma-separated list - no spaces), or 'all'. Shows all users who can access the account, and via group or direct access.
+get-users-for-ou - OPTION required here is an OU name, path (e.g. Root/Workloads/Prod) or ID. As get-users-for-accounts, for every active account in the OU or below it.
+get-users-for-permission-set - OPTION required here is a permission set name. Lists every user who has the permission set in any account (directly or via a group), with how many accounts.
+get-users-for-action - OPTION required here is an IAM action, optionally followed by account names / IDs, comma-separated (no spaces), e.g. iam:PassRole,prod-account.
+                       Lists every user who may perform the action in those accounts (default all), with the permission set and the policy statement that
+                       allows it (wildcards such as s3:* and NotAction included). Resources and conditions are listed, not evaluated; customer-managed policies
+                       can't be read from the management account and are listed as not evaluated.
+compare-users - OPTION required here is two usernames, comma-separated (no spaces). Lists the account / permission set pairs that only one of the two users can use.
+diff - OPTION required here is a group YAML file or directory (or a comma-separated list - no spaces). Expands the definitions as the group module does and lists the
+       entitlements that are missing from Identity Centre, extra (assigned to a defined group but not defined) or stale (permission set changed but not re-provisioned),
+       without a terraform plan. OUs are resolved through --ou-map PATH (e.g. `terraform output -json org_ou_account_map > ou_map.json`), or by crawling the organisation.
+serve - OPTION (optional) is HOST:PORT (default 127.0.0.1:8787) or the path of a Unix socket. Runs a daemon that keeps the data loaded in memory, refreshes it in the
+        background (see --refresh-every, or --offline to serve the store as it is) and answers the commands above (except refresh, merge and diff) over HTTP in milliseconds, e.g.
+        curl 'http://127.0.0.1:8787/get-accounts-for-group?option=GROUP'. Responses are JSON with the rows and the age of the data (also in X-Data-Age-Seconds).
+refresh - Re-crawls only the stale entities in the snapshot store (see --max-age). OPTION (optional) is a permission set, group or account name to refresh just that entity's assignments / memberships.
+merge - OPTION required here is the shard stores (comma-separated, no spaces) of a complete set of `refresh --shard I/N` runs. Combines them into --store, so
+        any command run --offline against it gives exactly the output of a single-process crawl.
 """
 
-import boto3, botocore
 import sys
 import os
 import logging
+import argparse
+import csv
+import gzip
+import io
+import json
+import random
+import re
+import sqlite3
+import stat
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import cache, cached_property
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain, islice
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, unquote, urlsplit
 
 # Logging
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
 logger.setLevel(logging.INFO)
-log = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
-log.setFormatter(formatter)
-logger.addHandler(log)
+
+def configure_logging():
+    # Only the command line attaches a handler, so importing the module doesn't change the caller's logging.
+    log = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
+    log.setFormatter(formatter)
+    logger.addHandler(log)
+
+# Concurrency and throttling
+## Identity Centre quotas are low (https://docs.aws.amazon.com/singlesignon/latest/userguide/limits.html), so every API
+## operation gets its own token bucket. Buckets halve their rate on a throttling error and creep back up on success.
+
+WORKERS = 1 # Size of the worker pool used to fan out calls. 1 runs everything in series.
+API_RATE = 10.0 # Requests per second allowed for each API operation.
+MAX_RETRIES = 8 # Attempts on a throttled (or transiently failing) call before giving up.
+THROTTLING_ERROR_CODES = ("ThrottlingException", "TooManyRequestsException", "Throttling", "RequestLimitExceeded")
+TRANSIENT_ERROR_CODES = ("InternalServerException", "InternalFailure", "ServiceUnavailable", "ServiceUnavailableException", "RequestTimeout", "RequestTimeoutException")
+
+class TokenBucket:
+
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 20, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class ThrottledClient:
+    # Wraps a (lazily created) boto3 client: each API call waits for a token from its operation's bucket and is retried with
+    # jittered exponential backoff when throttled. Anything that isn't an API method is passed straight through.
+
+    buckets = {}
+    buckets_lock = threading.Lock()
+
+    def __init__(self, service_name):
+        self._service_name = service_name
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        # The boto3 client is only created on first use.
+        with self._lock:
+            if self._client is None:
+                self._client = get_session().client(self._service_name)
+            return self._client
+
+    def __getattr__(self, name):
+        import botocore.exceptions
+        attribute = getattr(self.client(), name)
+        if name.startswith("_") or name == "exceptions" or not callable(attribute):
+            return attribute
+        def call(**kwargs):
+            bucket = self.bucket(name)
+            for attempt in range(MAX_RETRIES):
+                bucket.acquire()
+                start = time.perf_counter()
+                try:
+                    response = attribute(**kwargs)
+                except botocore.exceptions.ClientError as error:
+                    code = error.response.get("Error", {}).get("Code")
+                    throttled = code in THROTTLING_ERROR_CODES
+                    transient = code in TRANSIENT_ERROR_CODES or error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+                    API_METRICS.record(name, time.perf_counter() - start, attempt, "throttled" if throttled else "error")
+                    if not (throttled or transient):
+                        raise
+                    if throttled:
+                        bucket.throttled()
+                    retry_reason = "throttled" if throttled else f"failed ({code})"
+                except (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError) as error:
+                    # Network blips: connection refused / reset, timeouts.
+                    API_METRICS.record(name, time.perf_counter() - start, attempt, "error")
+                    retry_reason = f"failed ({type(error).__name__})"
+                except Exception:
+                    API_METRICS.record(name, time.perf_counter() - start, attempt, "error")
+                    raise
+                else:
+                    API_METRICS.record(name, time.perf_counter() - start, attempt, "ok")
+                    bucket.succeeded()
+                    return response
+                delay = random.uniform(0, min(20, 0.5 * 2 ** attempt))
+                logger.warning("%s %s, retrying in %.1fs (attempt %s of %s).", name, retry_reason, delay, attempt + 1, MAX_RETRIES)
+                time.sleep(delay)
+            raise Exception(f"{name} still failing after {MAX_RETRIES} attempts.")
+        return call
+
+    @classmethod
+    def bucket(cls, name):
+        with cls.buckets_lock:
+            if name not in cls.buckets:
+                cls.buckets[name] = TokenBucket(API_RATE)
+            return cls.buckets[name]
+
+def configure_concurrency(workers, rate):
+    global WORKERS, API_RATE
+    WORKERS = workers
+    API_RATE = rate
+    with ThrottledClient.buckets_lock:
+        for bucket in ThrottledClient.buckets.values():
+            bucket.max_rate = bucket.rate = rate
+
+def run_concurrently(function, items, description=None):
+    # Map function over items with the worker pool, returning results in the same order as items.
+    # With a description, the fan-out is reported as a stage by the progress line.
+    return list(stream_concurrently(function, items, description))
+
+def stream_concurrently(function, items, description=None):
+    # As run_concurrently, but yields each result (in order) as soon as it and those before it are done, so callers
+    # can start writing output before the whole fan-out has finished. At most a few results per worker are held.
+    items = list(items)
+    if description:
+        PROGRESS.start_stage(description, len(items))
+        task = function
+        def function(item):
+            result = task(item)
+            PROGRESS.advance()
+            return result
+    if WORKERS <= 1 or len(items) <= 1:
+        for item in items:
+            yield function(item)
+        return
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= WORKERS * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Instrumentation
+## Every API call made through a ThrottledClient is recorded per operation: calls, pages, errors, retries, throttles and
+## a latency histogram. Commands add the number of rows they emit. The totals can be written at the end of a run as
+## JSON or as a Prometheus textfile (for the node_exporter textfile collector), and a progress line with an estimated
+## time remaining can be logged periodically while the crawl runs.
+
+class ApiMetrics:
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Seconds (upper bounds), as Prometheus histogram buckets.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.operations = {}
+        self.rows = Counter() # {command: rows}
+
+    def record(self, operation, latency, attempt, outcome):
+        with self.lock:
+            metrics = self.operations.get(operation)
+            if metrics is None:
+                metrics = self.operations[operation] = {
+                    "calls": 0, "pages": 0, "errors": 0, "retries": 0, "throttles": 0,
+                    "latency_sum": 0.0, "latency_buckets": [0] * (len(self.LATENCY_BUCKETS) + 1),
+                }
+            metrics["calls"] += 1
+            metrics["retries"] += attempt > 0
+            metrics["latency_sum"] += latency
+            metrics["latency_buckets"][bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+            if outcome == "throttled":
+                metrics["throttles"] += 1
+            elif outcome == "error":
+                metrics["errors"] += 1
+            elif operation.startswith("list_"):
+                metrics["pages"] += 1
+
+    def total(self, key):
+        with self.lock:
+            return sum(metrics[key] for metrics in self.operations.values())
+
+    def summary(self):
+        with self.lock:
+            operations = {}
+            for operation, metrics in sorted(self.operations.items()):
+                cumulative = 0
+                buckets = {}
+                for upper_bound, count in zip(self.LATENCY_BUCKETS + ("+Inf",), metrics["latency_buckets"]):
+                    cumulative += count
+                    buckets[str(upper_bound)] = cumulative
+                operations[operation] = {
+                    key: metrics[key] for key in ("calls", "pages", "errors", "retries", "throttles")
+                } | {"latency_seconds": {"sum": round(metrics["latency_sum"], 6), "count": metrics["calls"], "buckets": buckets}}
+            return {
+                "started_at": self.started_at,
+                "duration_seconds": round(time.time() - self.started_at, 3),
+                "rows": dict(self.rows),
+                "operations": operations,
+            }
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP idc_helper_{name} {help_text}")
+            lines.append(f"# TYPE idc_helper_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"idc_helper_{name}{{{label_text}}} {value}" if label_text else f"idc_helper_{name} {value}")
+        operations = summary["operations"]
+        for key, help_text in (
+            ("calls", "API calls made, including retries."),
+            ("pages", "Pages returned by paginated list operations."),
+            ("errors", "API calls that failed with an error other than throttling, including 5xx, transient and network errors that were retried."),
+            ("retries", "API calls that were retries of a throttled, 5xx, transiently failing or network-failed call."),
+            ("throttles", "API calls that were throttled."),
+        ):
+            metric(f"api_{key}_total", "counter", help_text, [({"operation": operation}, metrics[key]) for operation, metrics in operations.items()])
+        metric("api_latency_seconds", "histogram", "API call latency.", [])
+        for operation, metrics in operations.items():
+            latency = metrics["latency_seconds"]
+            lines.extend(f'idc_helper_api_latency_seconds_bucket{{operation="{operation}",le="{upper_bound}"}} {count}' for upper_bound, count in latency["buckets"].items())
+            lines.append(f'idc_helper_api_latency_seconds_sum{{operation="{operation}"}} {latency["sum"]}')
+            lines.append(f'idc_helper_api_latency_seconds_count{{operation="{operation}"}} {latency["count"]}')
+        metric("rows_total", "counter", "Rows emitted by the command.", [({"command": command}, rows) for command, rows in summary["rows"].items()])
+        metric("run_duration_seconds", "gauge", "Wall time of the run.", [({}, summary["duration_seconds"])])
+        metric("run_timestamp_seconds", "gauge", "When the run started (epoch seconds).", [({}, summary["started_at"])])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Prometheus textfile for *.prom, JSON otherwise. Written via a temporary file so collectors never read half a file.
+        content = self.prometheus() if path.endswith(".prom") else json.dumps(self.summary(), indent=2)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    def log_summary(self):
+        logger.info(
+            "API calls: %s (%s pages, %s throttled, %s retries, %s errors) in %.1fs.",
+            self.total("calls"), self.total("pages"), self.total("throttles"), self.total("retries"), self.total("errors"),
+            time.time() - self.started_at,
+        )
+
+class Progress:
+    # Tracks the current fan-out stage, so a background thread can log how far through it is and how long is left.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage = None
+        self.total = 0
+        self.done = 0
+        self.stage_started = time.monotonic()
+
+    def start_stage(self, stage, total):
+        with self.lock:
+            self.stage, self.total, self.done, self.stage_started = stage, total, 0, time.monotonic()
+
+    def advance(self):
+        with self.lock:
+            self.done += 1
+
+    def line(self):
+        with self.lock:
+            if self.stage is None:
+                return f"Progress: {API_METRICS.total('calls')} API calls so far."
+            elapsed = time.monotonic() - self.stage_started
+            remaining = elapsed / self.done * (self.total - self.done) if self.done else None
+            eta = f"{remaining:.0f}s remaining" if remaining is not None else "estimating time remaining"
+            return f"Progress: {self.stage} {self.done}/{self.total} ({self.done / max(self.total, 1):.0%}), {eta}. {API_METRICS.total('calls')} API calls so far."
+
+    def report_every(self, interval):
+        def report():
+            while True:
+                time.sleep(interval)
+                logger.info(self.line())
+        threading.Thread(target=report, daemon=True).start()
+
+API_METRICS = ApiMetrics()
+PROGRESS = Progress()
+
+
+# Resolver cache
+## The describe_* lookups below resolve the same handful of IDs over and over, so responses are memoised by ID in a
+## size-bounded LRU with a TTL. ResourceNotFoundException is cached too (negative caching), so a deleted user is only
+## looked up once per run.
+
+CACHE_SIZE = 10000 # Maximum entries held by each resolver cache.
+CACHE_TTL = 3600 # Seconds before a cached entry is looked up again.
+
+class ResolverCache:
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader, not_found=()):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > CACHE_TTL:
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                if isinstance(entry[1], Exception):
+                    self.negative_hits += 1
+                    raise self.fresh(entry[1])
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        try:
+            value = loader()
+        except not_found as error:
+            self.put(key, error)
+            raise
+        self.put(key, value)
+        return value
+
+    @staticmethod
+    def fresh(error):
+        # A new instance of a cached exception for each hit. Re-raising the cached one would keep extending its
+        # __traceback__ (and share it between threads); __init__ is skipped as subclasses take different arguments.
+        copy = type(error).__new__(type(error), *error.args)
+        copy.__dict__.update(vars(error))
+        return copy
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > CACHE_SIZE:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        hit_rate = (self.hits + self.negative_hits) / lookups if lookups else 0
+        return f"{self.name} cache: {lookups} lookups, {self.hits} hits, {self.negative_hits} negative hits, {self.misses} misses, {self.evictions} evictions ({hit_rate:.0%} hit rate)."
+
+RESOLVER_CACHES = {name: ResolverCache(name) for name in ("permission_set", "account", "group", "user")}
+
+def configure_cache(size, ttl):
+    global CACHE_SIZE, CACHE_TTL
+    CACHE_SIZE = size
+    CACHE_TTL = ttl
+
+def log_cache_stats():
+    for cache in RESOLVER_CACHES.values():
+        logger.info(cache.stats())
+
 
 # Boto3 initialisation
-## Session
-try:
-    boto3_session = boto3.Session(profile_name=os.environ['AWS_PROFILE'])
-except KeyError:
-    raise Exception("Ensure env var AWS_PROFILE is set.")
+## Nothing touches AWS at import time. The session, clients, SSO instance and account map are created on first use, so
+## `help` and --offline runs start instantly and the functions can be imported as a library (see IdcHelper).
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import boto3 # Deferred: importing boto3 alone takes a noticeable fraction of a second.
+            try:
+                _session = boto3.Session(profile_name=os.environ['AWS_PROFILE'])
+            except KeyError:
+                raise Exception("Ensure env var AWS_PROFILE is set.")
+        return _session
+
+def set_session(session):
+    # Use an existing boto3 session (e.g. when embedding, or a fake backend) instead of the AWS_PROFILE one.
+    global _session
+    with _session_lock:
+        _session = session
+    reset_state()
+
+def reset_state():
+    # Forget every client, memoised lookup, cache entry, rate limit and metric, as if the module had just been imported.
+    for client in (idc_client, sso_client, org_client, iam_client):
+        client._client = None
+    for function in (get_sso_instance, get_account_map, get_account_details, get_account_index):
+        function.cache_clear()
+    for name in RESOLVER_CACHES:
+        RESOLVER_CACHES[name] = ResolverCache(name)
+    with ThrottledClient.buckets_lock:
+        ThrottledClient.buckets.clear()
+    global API_METRICS, PROGRESS
+    API_METRICS = ApiMetrics()
+    PROGRESS = Progress()
+
 ## Identity Centre Client
-idc_client = boto3_session.client('identitystore')
+idc_client = ThrottledClient('identitystore')
 ## SSO Client
-sso_client = boto3_session.client('sso-admin')
-try:
-    client_sso_instance = sso_client.list_instances()["Instances"][0]
-except botocore.exceptions.SSOTokenLoadError:
-    raise Exception("SSO Token Error. Ensure your session is logged in and not expired.")
-logger.debug(f"client_sso_instance: {client_sso_instance}")
+sso_client = ThrottledClient('sso-admin')
 ## AWS ORganisation Client
-org_client = boto3_session.client('organizations')
+org_client = ThrottledClient('organizations')
+## IAM Client (AWS-managed policy documents)
+iam_client = ThrottledClient('iam')
+
+@cache
+def get_sso_instance():
+    import botocore.exceptions
+    try:
+        client_sso_instance = sso_client.list_instances()["Instances"][0]
+    except botocore.exceptions.SSOTokenLoadError:
+        raise Exception("SSO Token Error. Ensure your session is logged in and not expired.")
+    logger.debug("client_sso_instance: %s", client_sso_instance)
+    return client_sso_instance
 
+@cache
+def get_account_map():
+    # Used to cache account IDs to Names and avoid repeated API calls since we reference this a lot.
+    return get_accounts()
 
-def get_permission_sets():
-    permission_sets = []
-    next_token = ""
+@cache
+def get_account_details():
+    # {AccountId: {Id, Arn, Email, Name, Status, ...}}: the metadata of every account from one listing, instead of a
+    # describe_account per account.
+    return {account["Id"]: account for account in paginate(org_client.list_accounts, "Accounts", MaxResults=20)}
+
+
+def paginate(operation, result_key, checkpoint=None, **kwargs):
+    # Generator over the items of every page of a list operation, following NextToken. Pages are fetched as the
+    # caller consumes items, so nothing is held beyond the current page.
+    # With a checkpoint ((Checkpoint, key)), the items so far and the next token are recorded after each page, and a
+    # listing that was interrupted resumes from its last recorded page (or restarts, if that token is rejected).
+    checkpoint, key = checkpoint or (None, None)
+    recorded, next_token = checkpoint.page(key) if checkpoint else ([], None)
+    if next_token:
+        kwargs["NextToken"] = next_token
+    items = []
     while True:
-        client_permission_sets = sso_client.list_permission_sets(
-            InstanceArn = client_sso_instance["InstanceArn"],
-            MaxResults=100,
-            NextToken=next_token
-        )
-        logger.debug(f"client_permission_sets: {client_permission_sets}")
-        permission_sets.extend(client_permission_sets["PermissionSets"])
-        if "NextToken" in client_permission_sets:
-            next_token=client_permission_sets["NextToken"]
-            logger.debug(f"next_token: {next_token}")
-        else:
-            logger.debug(f"permission_sets: {permission_sets}")
-            break
-    return permission_sets
+        try:
+            page = operation(**kwargs)
+        except Exception as error:
+            if not recorded:
+                raise
+            logger.warning("Restarting %s listing, resuming it failed: %s", result_key, error)
+            recorded = []
+            kwargs.pop("NextToken")
+            continue
+        logger.debug("%s: %s", result_key, page)
+        if recorded: # Resumed: the recorded pages come first.
+            yield from recorded
+            items, recorded = recorded, []
+        yield from page[result_key]
+        if "NextToken" not in page:
+            return
+        kwargs["NextToken"] = page["NextToken"]
+        logger.debug("next_token: %s", kwargs["NextToken"])
+        if checkpoint:
+            items = items + page[result_key]
+            checkpoint.record_page(key, items, kwargs["NextToken"])
+
+def get_permission_sets():
+    return paginate(sso_client.list_permission_sets, "PermissionSets",
+        InstanceArn = get_sso_instance()["InstanceArn"],
+        MaxResults=100
+    )
 
 def get_provisioned_permission_sets(account_id):
-    provisioned_permission_sets = []
-    next_token = ""
-    while True:
-        client_provisioned_permission_sets = sso_client.list_permission_sets_provisioned_to_account(
-            AccountId=account_id,
-            InstanceArn=client_sso_instance["InstanceArn"],
-            MaxResults=100,
-            NextToken=next_token
-            # ProvisioningStatus='LATEST_PERMISSION_SET_PROVISIONED'|'LATEST_PERMISSION_SET_NOT_PROVISIONED'
-        )
-        logger.debug(f"client_provisioned_permission_sets: {client_provisioned_permission_sets}")
-        provisioned_permission_sets.extend(client_provisioned_permission_sets["PermissionSets"])
-        if "NextToken" in client_provisioned_permission_sets:
-            next_token=client_provisioned_permission_sets["NextToken"]
-            logger.debug(f"next_token: {next_token}")
-        else:
-            logger.debug(f"provisioned_permission_sets: {provisioned_permission_sets}")
-            break
-    return provisioned_permission_sets
+    return paginate(sso_client.list_permission_sets_provisioned_to_account, "PermissionSets",
+        AccountId=account_id,
+        InstanceArn=get_sso_instance()["InstanceArn"],
+        MaxResults=100
+        # ProvisioningStatus='LATEST_PERMISSION_SET_PROVISIONED'|'LATEST_PERMISSION_SET_NOT_PROVISIONED'
+    )
 
 def get_permission_set_property(PermissionSetArn,property):
-    permission_set = sso_client.describe_permission_set(
-        InstanceArn = client_sso_instance["InstanceArn"],
+    permission_set = RESOLVER_CACHES["permission_set"].get(PermissionSetArn, lambda: sso_client.describe_permission_set(
+        InstanceArn = get_sso_instance()["InstanceArn"],
         PermissionSetArn=PermissionSetArn
-    )
-    logger.debug(f"permission_set: {permission_set}")
+    ))
+    logger.debug("permission_set: %s", permission_set)
     return permission_set['PermissionSet'][property]
 
+def get_inline_policy(permission_set):
+    # The parsed policy document, None if the permission set has no inline policy.
+    policy = sso_client.get_inline_policy_for_permission_set(
+        InstanceArn = get_sso_instance()["InstanceArn"],
+        PermissionSetArn=permission_set
+    )["InlinePolicy"]
+    return json.loads(policy) if policy else None
 
-def get_accounts():
-    account_dict = {}
-    accounts = org_client.list_accounts(MaxResults=20)
-    while True:
-        for account in accounts['Accounts']:
-            account_dict[account['Id']]=account['Name']
-        if "NextToken" in accounts:
-            accounts = org_client.list_accounts(MaxResults=20,NextToken=accounts["NextToken"])
-        else:
-            break
-    return account_dict
+def get_managed_policies(permission_set):
+    # Attached AWS-managed policies: {Name, Arn}.
+    return paginate(sso_client.list_managed_policies_in_permission_set, "AttachedManagedPolicies",
+        InstanceArn=get_sso_instance()["InstanceArn"],
+        MaxResults=100,
+        PermissionSetArn=permission_set
+    )
+
+def get_customer_managed_policy_references(permission_set):
+    # Attached customer-managed policies: {Name, Path}. The policies themselves live in each member account.
+    return paginate(sso_client.list_customer_managed_policy_references_in_permission_set, "CustomerManagedPolicyReferences",
+        InstanceArn=get_sso_instance()["InstanceArn"],
+        MaxResults=100,
+        PermissionSetArn=permission_set
+    )
 
-# Look up the Accounta dictionary in reverse to get the ID from the name.
-def get_account_id_from_name(account_name):
+def get_managed_policy_document(policy_arn):
+    # The default version of an AWS-managed policy, None if it no longer exists. boto3 normally decodes the
+    # document, which is URL-encoded JSON on the wire.
     try:
-        account_id=list(AWS_ACCOUNTS.keys())[list(AWS_ACCOUNTS.values()).index(account_name)]
-    except ValueError:
-        logger.error(f"Account name {account_name} or account ID not found.")
-        quit()
-    logger.debug(f"account_id: {account_id}")
+        policy = iam_client.get_policy(PolicyArn=policy_arn)["Policy"]
+    except iam_client.exceptions.NoSuchEntityException:
+        return None
+    document = iam_client.get_policy_version(PolicyArn=policy_arn, VersionId=policy["DefaultVersionId"])["PolicyVersion"]["Document"]
+    return json.loads(unquote(document)) if isinstance(document, str) else document
+
+
+def get_accounts():
+    return {account['Id']: account['Name'] for account in paginate(org_client.list_accounts, "Accounts", MaxResults=20)}
+
+def get_ous_for_parent(parent_id):
+    # Child OUs, with their names.
+    return paginate(org_client.list_organizational_units_for_parent, "OrganizationalUnits", ParentId=parent_id, MaxResults=20)
+
+def get_accounts_for_parent(parent_id):
+    # Child accounts, with their metadata.
+    return paginate(org_client.list_accounts_for_parent, "Accounts", ParentId=parent_id, MaxResults=20)
+
+class AccountIndex:
+    # Bidirectional account lookups, built once from the {AccountId: Name} map. Names (exact, then case-insensitive)
+    # and account IDs are all accepted as aliases. A name shared by several accounts is never guessed at: looking it
+    # up raises with the candidate IDs, and the account ID has to be used instead.
+
+    def __init__(self, accounts, ou_index=None):
+        # ou_index returns the OuIndex used for ou_path(); by default the organisation tree is crawled on first use.
+        self.names = accounts
+        self.ids_by_name = defaultdict(list)
+        self.ids_by_folded_name = defaultdict(list)
+        for account_id, name in accounts.items():
+            self.ids_by_name[name].append(account_id)
+            self.ids_by_folded_name[name.casefold()].append(account_id)
+        self._ou_index = ou_index or (lambda: OuIndex(crawl_org_tree()))
+        self._ou_paths = None
+
+    def resolve(self, account):
+        # Account name, account ID or case-insensitive name -> account ID.
+        if account in self.names:
+            return account
+        account_ids = self.ids_by_name.get(account) or self.ids_by_folded_name.get(account.casefold(), [])
+        if len(account_ids) > 1:
+            raise Exception(f"Account name '{account}' is ambiguous, it matches accounts {', '.join(sorted(account_ids))}. Use the account ID instead.")
+        if not account_ids:
+            raise Exception(f"Account name {account} or account ID not found.")
+        return account_ids[0]
+
+    def name(self, account_id):
+        return self.names[account_id]
+
+    def ou_path(self, account_id):
+        # e.g. "Root/OU-1/OU-2". The OU index is built once, on first use.
+        if self._ou_paths is None:
+            self._ou_paths = self._ou_index()
+        return self._ou_paths.account_path(account_id)
+
+def crawl_org_tree():
+    # {Id: node} for the root(s), every OU and every account, walking the organisation tree breadth first. The OUs of
+    # each level are listed concurrently (child OUs come with their names, child accounts with their metadata), so the
+    # crawl takes one round of calls per level of the tree rather than one per OU, and no describe_* calls.
+    # Nodes are {"Type": "ROOT" | "ORGANIZATIONAL_UNIT", "Name", "Parent", "Path", "Ous": [Id], "Accounts": [Id]}, or
+    # {"Type": "ACCOUNT", "Parent", and the account's Name, Email, Status, ...}.
+    tree = {}
+    for root in org_client.list_roots()["Roots"]:
+        tree[root["Id"]] = {"Type": "ROOT", "Name": root["Name"], "Parent": None, "Path": root["Name"], "Ous": [], "Accounts": []}
+    level = list(tree)
+    while level:
+        tasks = [(parent_id, listing) for parent_id in level for listing in (get_ous_for_parent, get_accounts_for_parent)]
+        children = run_concurrently(lambda task: list(task[1](task[0])), tasks, "organisation tree")
+        level = []
+        for (parent_id, listing), nodes in zip(tasks, children):
+            parent = tree[parent_id]
+            for node in nodes:
+                if listing is get_ous_for_parent:
+                    tree[node["Id"]] = {"Type": "ORGANIZATIONAL_UNIT", "Name": node["Name"], "Parent": parent_id, "Path": f"{parent['Path']}/{node['Name']}", "Ous": [], "Accounts": []}
+                    parent["Ous"].append(node["Id"])
+                    level.append(node["Id"])
+                else:
+                    tree[node["Id"]] = {**node, "Type": "ACCOUNT", "Parent": parent_id}
+                    parent["Accounts"].append(node["Id"])
+    logger.info(f"Organisation: {len(tree) - sum(node['Type'] == 'ACCOUNT' for node in tree.values())} OUs (with the root).")
+    return tree
+
+class OuIndex:
+    # OU lookups over the organisation tree (see crawl_org_tree()). OUs are accepted by ID, by path ("Root/OU/...") or
+    # by name, as the org and group modules key them. A name shared by several OUs is never guessed at: looking it up
+    # raises with the candidate paths, and the path or ID has to be used instead.
+
+    def __init__(self, org_tree):
+        self.tree = org_tree
+        self.ou_ids = [node_id for node_id, node in org_tree.items() if node["Type"] != "ACCOUNT"]
+        self.ids_by_name = defaultdict(list)
+        self.ids_by_path = {}
+        for ou_id in self.ou_ids:
+            self.ids_by_name[org_tree[ou_id]["Name"]].append(ou_id)
+            self.ids_by_path[org_tree[ou_id]["Path"]] = ou_id
+
+    def resolve(self, ou):
+        # OU name, path or ID -> OU ID.
+        if ou in self.tree and self.tree[ou]["Type"] != "ACCOUNT":
+            return ou
+        if ou in self.ids_by_path:
+            return self.ids_by_path[ou]
+        ou_ids = self.ids_by_name.get(ou, [])
+        if len(ou_ids) > 1:
+            raise Exception(f"OU name '{ou}' is ambiguous, it matches {', '.join(sorted(self.tree[ou_id]['Path'] for ou_id in ou_ids))}. Use the path or OU ID instead.")
+        if not ou_ids:
+            raise Exception(f"OU name, path or ID {ou} not found.")
+        return ou_ids[0]
+
+    def child_accounts(self, ou_id):
+        return self.tree[ou_id]["Accounts"]
+
+    def descendant_accounts(self, ou_id):
+        # The OU's own accounts, then each child OU's descendants, in tree order.
+        node = self.tree[ou_id]
+        return node["Accounts"] + [account_id for child_id in node["Ous"] for account_id in self.descendant_accounts(child_id)]
+
+    def active(self, account_ids):
+        return [account_id for account_id in account_ids if self.tree[account_id]["Status"] == "ACTIVE"]
+
+    def account_path(self, account_id):
+        node = self.tree.get(account_id)
+        return self.tree[node["Parent"]]["Path"] if node else None
+
+    def org_ou_account_map(self):
+        # The org module's org_ou_account_map output (org/main.tf): {"child_accounts": {OU name: {"active": [account
+        # name], "inactive": [account name]}}, "descendant_accounts": {...}}. OUs are keyed by name and include the root.
+        def by_status(account_ids):
+            active = set(self.active(account_ids))
+            return {
+                "active": [self.tree[account_id]["Name"] for account_id in account_ids if account_id in active],
+                "inactive": [self.tree[account_id]["Name"] for account_id in account_ids if account_id not in active],
+            }
+        return {
+            "child_accounts": {self.tree[ou_id]["Name"]: by_status(self.child_accounts(ou_id)) for ou_id in self.ou_ids},
+            "descendant_accounts": {self.tree[ou_id]["Name"]: by_status(self.descendant_accounts(ou_id)) for ou_id in self.ou_ids},
+        }
+
+@cache
+def get_account_index():
+    return AccountIndex(get_account_map())
+
+def get_account_id_from_name(account_name, index=None):
+    account_id = (index or get_account_index()).resolve(account_name)
+    logger.debug("account_id: %s", account_id)
     return account_id
 
 def get_account_property(AccountId,property):
-    account = org_client.describe_account(
+    # From the bulk listing, falling back to describe_account for an account created since it was made.
+    account = get_account_details().get(AccountId) or RESOLVER_CACHES["account"].get(AccountId, lambda: org_client.describe_account(
         AccountId=AccountId
-    )
-    logger.debug(f"account: {account}")
-    return account['Account'][property]
+    ))['Account']
+    logger.debug("account: %s", account)
+    return account[property]
 
-def get_account_assignments(permission_set, account_id):
-    account_assignments = []
-    next_token = ""
-    while True:
-        client_account_assignments = sso_client.list_account_assignments(
-            AccountId = account_id,
-            InstanceArn = client_sso_instance["InstanceArn"],
-            MaxResults=100,
-            NextToken=next_token,
-            PermissionSetArn = permission_set
-        )
-        logger.debug(f"client_account_assignments: {client_account_assignments}")
-        account_assignments.extend(client_account_assignments["AccountAssignments"])
-        if "NextToken" in client_account_assignments:
-            next_token=client_account_assignments["NextToken"]
-            logger.debug(f"next_token: {next_token}")
-        else:
-            logger.debug(f"account_assignments: {account_assignments}")
-            break
-    return account_assignments
+def get_account_assignments(permission_set, account_id, checkpoint=None):
+    return paginate(sso_client.list_account_assignments, "AccountAssignments", checkpoint,
+        AccountId = account_id,
+        InstanceArn = get_sso_instance()["InstanceArn"],
+        MaxResults=100,
+        PermissionSetArn = permission_set
+    )
 
 def get_account_assignments_for_principal(principal_id, principal_type):
-    account_assignments = []
-    client_account_assignments_for_principal = sso_client.list_account_assignments_for_principal(
-        InstanceArn = client_sso_instance["InstanceArn"],
+    return paginate(sso_client.list_account_assignments_for_principal, "AccountAssignments",
+        InstanceArn = get_sso_instance()["InstanceArn"],
         MaxResults=100,
         PrincipalId=principal_id,
         PrincipalType=principal_type
     )
-    logger.debug(f"client_account_assignments_for_principal: {client_account_assignments_for_principal}")
-    while True:
-        account_assignments.extend(client_account_assignments_for_principal["AccountAssignments"])
-        if "NextToken" in client_account_assignments_for_principal:
-            client_account_assignments_for_principal = sso_client.list_account_assignments_for_principal(
-                InstanceArn = client_sso_instance["InstanceArn"],
-                MaxResults=100,
-                NextToken=client_account_assignments_for_principal["NextToken"],
-                PrincipalId=principal_id,
-                PrincipalType=principal_type
-            )
-            logger.debug(f"client_account_assignments_for_principal: {client_account_assignments_for_principal}")
-        else:
-            logger.debug(f"account_assignments: {account_assignments}")
-            break
-    return account_assignments
-
-def get_permission_set_accounts(permission_set):
-    logger.debug(f"permission_set: {permission_set}")
-    accounts = []
-    next_token = ""
-    while True:
-        permission_set_accounts = sso_client.list_accounts_for_provisioned_permission_set(
-            InstanceArn=client_sso_instance["InstanceArn"],
-            MaxResults=100,
-            NextToken=next_token,
-            PermissionSetArn=permission_set
-            # ProvisioningStatus='LATEST_PERMISSION_SET_PROVISIONED'|'LATEST_PERMISSION_SET_NOT_PROVISIONED'
-        )
-        accounts.extend(permission_set_accounts["AccountIds"])
-        if "NextToken" in permission_set_accounts:
-            next_token=permission_set_accounts["NextToken"]
-        else:
-            return accounts
+
+def get_permission_set_accounts(permission_set, provisioning_status=None, checkpoint=None):
+    # provisioning_status: 'LATEST_PERMISSION_SET_PROVISIONED'|'LATEST_PERMISSION_SET_NOT_PROVISIONED' (default both).
+    logger.debug("permission_set: %s", permission_set)
+    return paginate(sso_client.list_accounts_for_provisioned_permission_set, "AccountIds", checkpoint,
+        InstanceArn=get_sso_instance()["InstanceArn"],
+        MaxResults=100,
+        PermissionSetArn=permission_set,
+        **({"ProvisioningStatus": provisioning_status} if provisioning_status else {})
+    )
 
 
 def get_principal(PrincipalId, PrincipalType):
-    logger.debug(f"PrincipalId, PrincipalType: {PrincipalId},{PrincipalType}")
+    logger.debug("PrincipalId, PrincipalType: %s,%s", PrincipalId, PrincipalType)
     principal={}
     if PrincipalType == "GROUP":
-        principal_group = idc_client.describe_group(
-            IdentityStoreId=client_sso_instance["IdentityStoreId"],
-            GroupId=PrincipalId
-        )
-        logger.debug(f"principal_group: {principal_group}")
-        if "Description" not in principal_group:
-            principal_group["Description"]=""
+        principal_group = describe_group(PrincipalId)
+        logger.debug("principal_group: %s", principal_group)
         principal["PrincipalId"]=principal_group["GroupId"]
         principal["DisplayName"]=principal_group["DisplayName"]
-        principal["Description"]=principal_group["Description"]
+        principal["Description"]=principal_group.get("Description", "")
     elif PrincipalType == "USER":
         try:
-            principal_user = idc_client.describe_user(
-                IdentityStoreId=client_sso_instance["IdentityStoreId"],
-                UserId=PrincipalId
-            )
-            logger.debug(f"principal_user: {principal_user}")
+            principal_user = describe_user(PrincipalId)
+            logger.debug("principal_user: %s", principal_user)
             principal["PrincipalId"]=principal_user["UserId"]
             principal["DisplayName"]=principal_user["DisplayName"]
             principal["Description"]=principal_user["UserName"]
@@ -220,278 +799,1816 @@ def get_principal(PrincipalId, PrincipalType):
             principal["PrincipalId"]=PrincipalId
             principal["DisplayName"]=PrincipalType
             principal["Description"]="NOT FOUND"
-    logger.debug(f"principal: {principal}")
+    logger.debug("principal: %s", principal)
     return principal
 
 def get_groups():
-    group_list = []
-    groups = idc_client.list_groups(
-        IdentityStoreId=client_sso_instance["IdentityStoreId"],
+    return paginate(idc_client.list_groups, "Groups",
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
         MaxResults=100
     )
-    logger.debug(f"groups: {groups}")
-    while True:
-        group_list.extend(groups["Groups"])
-        if "NextToken" in groups:
-            groups = idc_client.list_groups(
-                IdentityStoreId=client_sso_instance["IdentityStoreId"],
-                MaxResults=100,
-                NextToken=groups["NextToken"]
-            )
-        else:
-            return group_list
 
-def get_group_property(GroupId,property):
-    group = idc_client.describe_group(
-        IdentityStoreId=client_sso_instance["IdentityStoreId"],
+def describe_group(GroupId):
+    return RESOLVER_CACHES["group"].get(GroupId, lambda: idc_client.describe_group(
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
         GroupId=GroupId
-    )
-    logger.debug(f"group: {group}")
+    ), not_found=idc_client.exceptions.ResourceNotFoundException)
+
+def get_group_property(GroupId,property):
+    group = describe_group(GroupId)
+    logger.debug("group: %s", group)
     return group[property]
 
 def get_group_id(AttributePath,AttributeValue):
-    logger.debug(f"AttributePath: {AttributePath}")
-    logger.debug(f"AttributeValue: {AttributeValue}")
+    logger.debug("AttributePath: %s", AttributePath)
+    logger.debug("AttributeValue: %s", AttributeValue)
     group = idc_client.list_groups(
-        IdentityStoreId=client_sso_instance["IdentityStoreId"],
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
         Filters=[{
             'AttributePath': AttributePath,
             'AttributeValue': AttributeValue
         }]
     )
-    logger.debug(f"group: {group}")
+    logger.debug("group: %s", group)
     if len(group["Groups"])==0:
         raise Exception("Group or GroupId not found.")
     return group["Groups"][0]["GroupId"]
 
 def get_user_groups(user_id):
-    group_list = []
-    groups = idc_client.list_group_memberships_for_member(
-        IdentityStoreId=client_sso_instance["IdentityStoreId"],
+    return paginate(idc_client.list_group_memberships_for_member, "GroupMemberships",
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
         MemberId={'UserId':user_id},
         MaxResults=100
     )
-    logger.debug(f"groups: {groups}")
-    logger.debug(f"GroupMemberships: {groups['GroupMemberships']}")
-    while True:
-        group_list.extend(groups["GroupMemberships"])
-        if "NextToken" in groups:
-            groups = idc_client.list_group_memberships_for_member(
-                IdentityStoreId=client_sso_instance["IdentityStoreId"],
-                MemberId={'UserId':user_id},
-                MaxResults=100,
-                NextToken=groups["NextToken"]
-            )
-        else:
-            return group_list
 
 def get_group_members(groupid):
-    logger.debug(f"groupid: {groupid}")
-    members = []
-    group_memberships = idc_client.list_group_memberships(
-        IdentityStoreId=client_sso_instance["IdentityStoreId"],
+    logger.debug("groupid: %s", groupid)
+    return paginate(idc_client.list_group_memberships, "GroupMemberships",
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
         GroupId=groupid,
         MaxResults=100
     )
-    logger.debug(f"group_memberships: {group_memberships}")
-    while True:
-        members.extend(group_memberships["GroupMemberships"])
-        if "NextToken" in group_memberships:
-            group_memberships = idc_client.list_group_memberships(
-                IdentityStoreId=client_sso_instance["IdentityStoreId"],
-                GroupId=groupid,
-                MaxResults=100,
-                NextToken=group_memberships["NextToken"]
-            )
-            logger.debug(f"group_memberships: {group_memberships}")
-        else:
-            break
-    return members
+
+def describe_user(UserId):
+    return RESOLVER_CACHES["user"].get(UserId, lambda: idc_client.describe_user(
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
+        UserId=UserId
+    ), not_found=idc_client.exceptions.ResourceNotFoundException)
 
 def get_user_property(userid,property):
-    logger.debug(f"userid, property: {userid},{property}")
-    user = idc_client.describe_user(
-        IdentityStoreId=client_sso_instance["IdentityStoreId"],
-        UserId=userid
-    )
-    logger.debug(f"user: {user}")
+    logger.debug("userid, property: %s,%s", userid, property)
+    user = describe_user(userid)
+    logger.debug("user: %s", user)
     return user[property]
 
+def get_users():
+    return paginate(idc_client.list_users, "Users",
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
+        MaxResults=100
+    )
+
 def get_user_id(AttributePath,AttributeValue):
-    logger.debug(f"AttributePath: {AttributePath}")
-    logger.debug(f"AttributeValue: {AttributeValue}")
+    logger.debug("AttributePath: %s", AttributePath)
+    logger.debug("AttributeValue: %s", AttributeValue)
     user = idc_client.list_users(
-        IdentityStoreId=client_sso_instance["IdentityStoreId"],
+        IdentityStoreId=get_sso_instance()["IdentityStoreId"],
         Filters=[{
             'AttributePath': AttributePath,
             'AttributeValue': AttributeValue
         }]
     )
-    logger.debug(f"user: {user}")
+    logger.debug("user: %s", user)
     if len(user["Users"])==0:
         raise Exception("User or UserId not found.")
     return user["Users"][0]["UserId"]
 
 
-# Constants
-AWS_ACCOUNTS=get_accounts() # Used to cache account IDs to Names and avoid repeated API calls since we reference this a lot.
+# Crawlers
+## Fan the per-entity list calls out over the worker pool. Used by the Snapshot and by `refresh`.
 
+def crawl_permission_sets():
+    # {PermissionSetArn: Name}. There is no list API returning names, so this is one describe per permission set.
+    permission_set_arns = list(get_permission_sets())
+    names = run_concurrently(lambda permission_set: get_permission_set_property(permission_set,'Name'), permission_set_arns, "permission set names")
+    return dict(zip(permission_set_arns, names))
 
-if __name__ == "__main__":
+## The paginators are lazy, so each task drains its own pages (list()) inside the worker thread.
 
-    f = open("idc_helper.csv", "w")
-    
-    args=sys.argv
-    logger.debug(f"args: {args}")
-    if len(args)<2 or args[1].lower()=="help":
-        print(__doc__)
+## With a Checkpoint, finished entities and the pages of unfinished ones are recorded, and replayed on resume.
+
+def crawl_permission_set_accounts(permission_set_arns, provisioning_status=None, checkpoint=None):
+    table = "permission_set_accounts" if provisioning_status is None else f"permission_set_accounts:{provisioning_status}"
+    crawl = lambda arn: list(get_permission_set_accounts(arn, provisioning_status, checkpoint and (checkpoint, (table, arn))))
+    return dict(crawl_resumably(crawl, permission_set_arns, table, checkpoint, "permission set accounts"))
+
+def stream_account_assignments(pairs, checkpoint=None):
+    # Yields ((PermissionSetArn, AccountId), [assignment]) in order of pairs, as each pair's crawl completes.
+    crawl = lambda pair: list(get_account_assignments(*pair, checkpoint and (checkpoint, ("account_assignments",) + pair)))
+    return crawl_resumably(crawl, pairs, "account_assignments", checkpoint, "account assignments")
+
+def crawl_account_assignments(pairs, checkpoint=None):
+    return dict(stream_account_assignments(pairs, checkpoint))
+
+def crawl_permission_set_policies(permission_set_arns):
+    # {PermissionSetArn: {"inline": document or None, "managed": [{Name, Arn}], "customer_managed": [{Name, Path}]}}.
+    # The three lookups of every permission set are fanned out together.
+    lookups = (
+        ("inline", get_inline_policy),
+        ("managed", lambda arn: list(get_managed_policies(arn))),
+        ("customer_managed", lambda arn: list(get_customer_managed_policy_references(arn))),
+    )
+    tasks = [(arn, kind, lookup) for arn in permission_set_arns for kind, lookup in lookups]
+    results = run_concurrently(lambda task: task[2](task[0]), tasks, "permission set policies")
+    policies = {arn: {} for arn in permission_set_arns}
+    for (arn, kind, _), result in zip(tasks, results):
+        policies[arn][kind] = result
+    return policies
+
+def crawl_managed_policies(permission_set_policies):
+    # {PolicyArn: document (None if deleted)} for every AWS-managed policy attached to a permission set, each read once.
+    policy_arns = sorted({policy["Arn"] for policies in permission_set_policies.values() for policy in policies["managed"]})
+    return dict(zip(policy_arns, run_concurrently(get_managed_policy_document, policy_arns, "managed policies")))
+
+def crawl_group_members(group_ids):
+    memberships = run_concurrently(lambda group_id: list(get_group_members(group_id)), group_ids, "group memberships")
+    return {
+        group_id: [member["MemberId"]["UserId"] for member in members]
+        for group_id, members in zip(group_ids, memberships)
+    }
+
+# Snapshot store
+## A local SQLite file that crawls are written into, so later commands can run --offline and `refresh` can re-crawl
+## only stale entities. Each entity (a whole top-level table, or one permission set's accounts, one permission set /
+## account pair's assignments, one group's members) is a row with its own capture time.
+
+STORE_PATH = "idc_helper.db"
+STALE_AFTER = 86400 # Seconds before `refresh` considers an entity stale.
+
+class SnapshotStore:
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS entities (
+            tbl TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            captured_at REAL NOT NULL,
+            PRIMARY KEY (tbl, key)
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS tables (tbl TEXT PRIMARY KEY, captured_at REAL NOT NULL)",
+    )
+
+    def __init__(self, path):
+        # The file is only created by the first write, so a run that fails before it has any data leaves nothing
+        # behind. Until then reads see an empty in-memory store.
+        self.path = path
+        self.open_lock = threading.Lock()
+        self.opened = os.path.exists(path)
+        self.connection = self.connect(path if self.opened else ":memory:")
+
+    def connect(self, path):
+        connection = sqlite3.connect(path, check_same_thread=False) # The daemon's request threads read what its refresh thread opened.
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    @property
+    def writer(self):
+        # The connection to write with, creating the file on first use.
+        with self.open_lock:
+            if not self.opened:
+                self.connection = self.connect(self.path)
+                self.opened = True
+        return self.connection
+
+    @staticmethod
+    def encode_key(key):
+        return "|".join(key) if isinstance(key, tuple) else key
+
+    @staticmethod
+    def decode_key(table, key):
+        return tuple(key.split("|")) if table.endswith("account_assignments") else key
+
+    def save(self, table, data, captured_at=None):
+        # Replace the whole table.
+        captured_at = captured_at or time.time()
+        connection = self.writer
+        with connection:
+            connection.execute("DELETE FROM entities WHERE tbl = ?", (table,))
+            connection.execute("INSERT OR REPLACE INTO tables (tbl, captured_at) VALUES (?, ?)", (table, captured_at))
+            connection.executemany(
+                "INSERT INTO entities (tbl, key, value, captured_at) VALUES (?, ?, ?, ?)",
+                [(table, self.encode_key(key), json.dumps(value, default=str), captured_at) for key, value in data.items()]
+            )
+
+    def update(self, table, key, value, captured_at=None):
+        # Replace one entity of a keyed table.
+        captured_at = captured_at or time.time()
+        connection = self.writer
+        with connection:
+            connection.execute("INSERT OR IGNORE INTO tables (tbl, captured_at) VALUES (?, ?)", (table, captured_at))
+            connection.execute(
+                "INSERT OR REPLACE INTO entities (tbl, key, value, captured_at) VALUES (?, ?, ?, ?)",
+                (table, self.encode_key(key), json.dumps(value, default=str), captured_at)
+            )
+
+    def prune(self, table, keep):
+        # Drop entities of a keyed table whose key is no longer in `keep`.
+        keep = {self.encode_key(key) for key in keep}
+        stale = [key for (key,) in self.connection.execute("SELECT key FROM entities WHERE tbl = ?", (table,)) if key not in keep]
+        if stale:
+            with self.connection:
+                self.connection.executemany("DELETE FROM entities WHERE tbl = ? AND key = ?", [(table, key) for key in stale])
+
+    def load(self, table):
+        return {
+            self.decode_key(table, key): json.loads(value)
+            for key, value in self.connection.execute("SELECT key, value FROM entities WHERE tbl = ? ORDER BY rowid", (table,))
+        }
+
+    def captures(self, table):
+        # {key: captured_at}
+        return {
+            self.decode_key(table, key): captured_at
+            for key, captured_at in self.connection.execute("SELECT key, captured_at FROM entities WHERE tbl = ?", (table,))
+        }
+
+    def captured_at(self, table):
+        # Capture time of the oldest entity in the table (or of the table itself if it is empty), None if never captured.
+        (captured_at,) = self.connection.execute("SELECT MIN(captured_at) FROM entities WHERE tbl = ?", (table,)).fetchone()
+        if captured_at is None:
+            row = self.connection.execute("SELECT captured_at FROM tables WHERE tbl = ?", (table,)).fetchone()
+            captured_at = row[0] if row else None
+        return captured_at
+
+    def count(self, table):
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM entities WHERE tbl = ?", (table,)).fetchone()
+        return count
+
+    def has(self, table):
+        return self.connection.execute("SELECT 1 FROM tables WHERE tbl = ?", (table,)).fetchone() is not None
+
+
+# Checkpoints
+## A long online list-entitlements records its progress in the store as it goes: every table it finishes, every
+## permission set whose accounts it has listed, every permission set / account pair whose assignments it has listed,
+## and the items and next token of listings still in progress. If the run dies (an SSO token expiring, a network
+## failure that outlasts the retries), the next run resumes from the checkpoint: finished work is replayed from the
+## store without API calls and only the rest is crawled, so the report comes out the same. The checkpoint is cleared
+## once the report is complete, and discarded if it is older than --max-age.
+
+CHECKPOINT_PREFIX = "checkpoint:"
+CHECKPOINT_EVERY = 1.0 # Seconds between writes of checkpoint progress (also written when the run fails).
+
+class Checkpoint:
+
+    def __init__(self, store_path, max_age=STALE_AFTER):
+        # Its own connection, since worker threads record progress while the snapshot writes tables.
+        self.store = SnapshotStore(store_path)
+        self.lock = threading.Lock()
+        self.pending = [] # [(table, key, value)] not yet written.
+        self.written_at = time.monotonic()
+        started_at = self.store.captured_at(CHECKPOINT_PREFIX + "started")
+        if started_at is not None and time.time() - started_at > max_age:
+            logger.info(f"Discarding the checkpoint from {time.ctime(started_at)}, it is older than {max_age:.0f}s.")
+            self.clear()
+            started_at = None
+        self.resumed = started_at is not None
+        if self.resumed:
+            logger.info(f"Resuming from the checkpoint of an interrupted run started {time.ctime(started_at)}: {self.store.count(CHECKPOINT_PREFIX + 'entity:account_assignments')} permission set / account pairs already crawled.")
+        else:
+            self.store.save(CHECKPOINT_PREFIX + "started", {})
+        self.pages = self.store.load(CHECKPOINT_PREFIX + "pages") # {key: {"items": [...], "token": NextToken}}
+
+    def table(self, table, crawl):
+        # (data, captured_at) of a whole table, crawled unless an earlier run finished it.
+        name = CHECKPOINT_PREFIX + "table:" + table
+        if self.store.has(name):
+            return self.store.load(name), self.store.captured_at(name)
+        captured_at = time.time()
+        data = crawl()
+        self.store.save(name, data, captured_at)
+        return data, captured_at
+
+    def entities(self, table):
+        # {key: value} of the entities of a keyed table finished by earlier runs.
+        return self.store.load(CHECKPOINT_PREFIX + "entity:" + table)
+
+    def record(self, table, key, value):
+        self.write(CHECKPOINT_PREFIX + "entity:" + table, key, value)
+
+    def page(self, key):
+        # (items so far, next token) of an unfinished listing, ([], None) if there is none.
+        page = self.pages.get(SnapshotStore.encode_key(key))
+        return (page["items"], page["token"]) if page else ([], None)
+
+    def record_page(self, key, items, token):
+        self.write(CHECKPOINT_PREFIX + "pages", key, {"items": items, "token": token})
+
+    def write(self, table, key, value):
+        # Progress is written in batches, at most every CHECKPOINT_EVERY seconds, rather than one transaction per entity.
+        with self.lock:
+            self.pending.append((table, key, value))
+            if time.monotonic() - self.written_at >= CHECKPOINT_EVERY:
+                self.flush_pending()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.flush_pending()
+
+    def flush_pending(self):
+        captured_at = time.time()
+        connection = self.store.writer
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO entities (tbl, key, value, captured_at) VALUES (?, ?, ?, ?)",
+                [(table, self.store.encode_key(key), json.dumps(value, default=str), captured_at) for table, key, value in self.pending]
+            )
+        self.pending = []
+        self.written_at = time.monotonic()
+
+    def clear(self):
+        with self.lock:
+            self.pending = []
+        with self.store.connection:
+            self.store.connection.execute("DELETE FROM entities WHERE tbl LIKE ?", (CHECKPOINT_PREFIX + "%",))
+            self.store.connection.execute("DELETE FROM tables WHERE tbl LIKE ?", (CHECKPOINT_PREFIX + "%",))
+
+def checkpointed(rows, checkpoint):
+    # Pass rows through, then clear the checkpoint once the last one has been produced. If the crawl fails, the
+    # progress so far is written out for the next run to resume from.
+    try:
+        yield from rows
+    except BaseException:
+        checkpoint.flush()
+        raise
+    checkpoint.clear()
+
+def crawl_resumably(function, keys, table, checkpoint=None, description=None):
+    # Yields (key, function(key)) in order of keys, like stream_concurrently. With a checkpoint, keys finished by an
+    # earlier run are taken from it (no API calls) and every key finished now is recorded in it.
+    keys = list(keys)
+    finished = checkpoint.entities(table) if checkpoint else {}
+    def task(key):
+        if key in finished:
+            return finished[key]
+        value = function(key)
+        if checkpoint:
+            checkpoint.record(table, key, value)
+        return value
+    return zip(keys, stream_concurrently(task, keys, description))
+
+# Snapshot
+## Every table is enumerated once with the list APIs (on first use) and indexed in memory, so commands are answered
+## without describe_* calls in the inner loops. Cost grows with the number of list pages, not the number of output rows.
+## Crawled tables are written to the SnapshotStore (if given). With offline=True the tables are read from the store instead.
 
-    elif args[1].lower()=="list-group-members":
-        f.write('group_name,user_name\n')
-        groups=get_groups()
-        logger.debug(f"groups: {groups}")
-        for group in groups:
-            logger.debug(f"group: {group}")
-            group_members=get_group_members(group["GroupId"])
-            logger.debug(f"group_members: {group_members}")
-            for group_member in group_members:
-                logger.debug(f"group_member: {group_member}")
-                user=get_user_property(group_member["MemberId"]["UserId"],"UserName")
-                output=f"{group['DisplayName']},{user}"
-                logger.info(output)
-                f.write(output+"\n")
-
-    elif args[1].lower()=="get-groups-for-account":
-        f.write('account_id,account_name,group,permission_set\n')
-        account_name=args[2]
-        logger.info(f"account_name: {account_name}")
-        account_id=get_account_id_from_name(account_name)
-        logger.info(f"account_name: {account_id}")
-        potential_groups=get_groups()
-        logger.debug(f"potential_groups: {potential_groups}")
-        for potential_group in potential_groups:
-            logger.debug(f"potential_group: {potential_group}")
-            account_assignments_for_principal=get_account_assignments_for_principal(potential_group["GroupId"],'GROUP')
-            logger.debug(f"account_assignments_for_principal: {account_assignments_for_principal}")
-            for account_assignment_for_principal in account_assignments_for_principal:
-                logger.debug(f"account_assignment_for_principal: {account_assignment_for_principal}")
-                if account_assignment_for_principal["AccountId"]==account_id:
-                    logger.debug(f"account_assignment_for_principal: {account_assignment_for_principal}")
-                    found_group_name=get_group_property(account_assignment_for_principal["PrincipalId"],'DisplayName')
-                    found_permission_set_name=get_permission_set_property(account_assignment_for_principal["PermissionSetArn"],'Name')
-                    logger.info(f"Group '{found_group_name}' has permission set '{found_permission_set_name}'.")
-                    output=f"{account_id},{account_name},{found_group_name},{found_permission_set_name}"
-                    f.write(output+"\n")
-                                                   
-    elif args[1].lower()=="get-accounts-for-group":
-        f.write('account_id,account_name,group,permission_set\n')
-        group_name=args[2]
-        logger.info(f"group_name: {group_name}")
-        group_id=get_group_id("DisplayName",group_name)
-        logger.debug(f"group_id: {group_id}")
-        account_assignments_for_principal=get_account_assignments_for_principal(group_id,'GROUP')
-        logger.debug(f"account_assignments_for_principal: {account_assignments_for_principal}")
-        for account_assignment_for_principal in account_assignments_for_principal:
-            logger.debug(f"account_assignment_for_principal: {account_assignment_for_principal}")
-            permission_set_name=get_permission_set_property(account_assignment_for_principal["PermissionSetArn"],'Name')
-            account_id=account_assignment_for_principal['AccountId']
-            logger.info(f"Can access account '{account_id}' ({AWS_ACCOUNTS[account_id]}) with permission set '{permission_set_name}'.")
-            output=f"{account_id},{AWS_ACCOUNTS[account_id]},{group_name},{permission_set_name}"
-            f.write(output+"\n")
-
-    elif args[1].lower()=="list-entitlements":
-        f.write('account_id,account_name,permission_set_name,principal_type,principal_name,principal_description\n')
-        permission_sets=get_permission_sets()
-        logger.debug(f"permission_sets: {permission_sets}")
-        for permission_set in permission_sets:
-            logger.info(f"permission_set: {permission_set}")
-            permission_set_name=get_permission_set_property(permission_set,'Name')
-            logger.debug(f"permission_set_name: {permission_set_name}")
-            permission_set_accounts=get_permission_set_accounts(permission_set)
-            logger.debug(f"permission_set_accounts: {permission_set_accounts}")
-            logger.info(f"Permission set in {len(permission_set_accounts)} accounts.")
-            for permission_set_account in permission_set_accounts:
-                logger.debug(f"permission_set, permission_set_account: {permission_set},{permission_set_account}")
-                account_name=AWS_ACCOUNTS[permission_set_account]
-                account_assignments=get_account_assignments(permission_set,permission_set_account)
-                logger.debug(f"account_assignments: {account_assignments}")
-                for account_assignment in account_assignments:
-                    logger.debug(f"account_assignment: {account_assignment}")
-                    principal = get_principal(
-                        account_assignment["PrincipalId"],
-                        account_assignment["PrincipalType"],
-                    )
-                    logger.debug(f"principal: {principal}")
-                    if "Description" not in principal:
-                        principal["Description"]=""
-                    output=f"{permission_set_account},{account_name},{permission_set_name},{account_assignment['PrincipalType']},{principal['DisplayName']},{principal['Description']}"
-                    logger.info(output)
-                    f.write(output+'\n')
-
-    elif args[1].lower()=="get-users-for-accounts":
-        f.write('account_id,account_name,permission_set_name,principal_type,group_name,user_name,user_display_name\n')
-        if args[2].lower()=="all":
-            account_names=AWS_ACCOUNTS.values()
+class Snapshot:
+
+    def __init__(self, store=None, offline=False, checkpoint=None):
+        self.store = store
+        self.offline = offline
+        self.checkpoint = checkpoint # Checkpoint of a resumable crawl, if any.
+        self.captured_at = {} # {table: epoch seconds}
+
+    def table(self, table, crawl):
+        if self.offline:
+            if not self.store.has(table):
+                raise Exception(f"'{table}' is not in the snapshot store ({self.store.path}). Run the command without --offline (or run refresh) first.")
+            self.captured_at[table] = self.store.captured_at(table)
+            return self.store.load(table)
+        if self.checkpoint:
+            return self.keep(table, *self.checkpoint.table(table, crawl))
+        return self.keep(table, crawl(), time.time())
+
+    def keep(self, table, data, captured_at):
+        # Record a freshly crawled table, in the store too if there is one.
+        self.captured_at[table] = captured_at
+        if self.store:
+            self.store.save(table, data, captured_at)
+        return data
+
+    def oldest_capture(self):
+        return min(self.captured_at.values()) if self.captured_at else None
+
+    @cached_property
+    def accounts(self):
+        # {AccountId: Name}
+        return self.table("accounts", get_account_map)
+
+    @cached_property
+    def account_index(self):
+        # OU paths come from the snapshot's org_tree, so offline they are read from the store.
+        return AccountIndex(self.accounts, lambda: self.ou_index)
+
+    @cached_property
+    def permission_sets(self):
+        # {PermissionSetArn: Name}
+        permission_sets = self.table("permission_sets", crawl_permission_sets)
+        logger.info(f"Snapshot: {len(permission_sets)} permission sets.")
+        return permission_sets
+
+    @cached_property
+    def permission_set_accounts(self):
+        # {PermissionSetArn: [AccountId]}
+        return self.table("permission_set_accounts", lambda: crawl_permission_set_accounts(list(self.permission_sets), checkpoint=self.checkpoint))
+
+    @cached_property
+    def outdated_permission_set_accounts(self):
+        # {PermissionSetArn: [AccountId]} where the permission set has changed since it was last provisioned to the account.
+        return self.table("outdated_permission_set_accounts", lambda: crawl_permission_set_accounts(list(self.permission_sets), "LATEST_PERMISSION_SET_NOT_PROVISIONED"))
+
+    @cached_property
+    def permission_set_policies(self):
+        # {PermissionSetArn: {"inline", "managed", "customer_managed"}}, see crawl_permission_set_policies().
+        return self.table("permission_set_policies", lambda: crawl_permission_set_policies(list(self.permission_sets)))
+
+    @cached_property
+    def managed_policies(self):
+        # {PolicyArn: document} of the attached AWS-managed policies.
+        return self.table("managed_policies", lambda: crawl_managed_policies(self.permission_set_policies))
+
+    @cached_property
+    def policy_index(self):
+        return PolicyIndex(self.permission_set_policies, self.managed_policies)
+
+    @cached_property
+    def org_tree(self):
+        # {Id: node} for the root, OUs and accounts, see crawl_org_tree().
+        return self.table("org_tree", crawl_org_tree)
+
+    @cached_property
+    def ou_index(self):
+        return OuIndex(self.org_tree)
+
+    @cached_property
+    def org_ou_account_map(self):
+        # As the org module's output, see OuIndex.org_ou_account_map().
+        return self.ou_index.org_ou_account_map()
+
+    @cached_property
+    def account_assignments(self):
+        # {(PermissionSetArn, AccountId): [{AccountId, PermissionSetArn, PrincipalType, PrincipalId}]}
+        pairs = [
+            (permission_set, account_id)
+            for permission_set, accounts in self.permission_set_accounts.items()
+            for account_id in accounts
+        ]
+        return self.table("account_assignments", lambda: crawl_account_assignments(pairs, self.checkpoint))
+
+    def stream_assignments(self):
+        # Like iterating self.assignments, but when the table has to be crawled each permission set / account pair's
+        # assignments are yielded as soon as that pair is done. The table is kept (and stored) once the crawl finishes.
+        if self.loaded("account_assignments"):
+            yield from self.assignments
+            return
+        captured_at = time.time()
+        pairs = [
+            (permission_set, account_id)
+            for permission_set, accounts in self.permission_set_accounts.items()
+            for account_id in accounts
+        ]
+        account_assignments = {}
+        for pair, pair_assignments in stream_account_assignments(pairs, self.checkpoint):
+            account_assignments[pair] = pair_assignments
+            yield from pair_assignments
+        self.__dict__["account_assignments"] = self.keep("account_assignments", account_assignments, captured_at)
+
+    @cached_property
+    def assignments(self):
+        # [{AccountId, PermissionSetArn, PrincipalType, PrincipalId}] in permission set / account order.
+        assignments = []
+        for pair_assignments in self.account_assignments.values():
+            assignments.extend(pair_assignments)
+        logger.info(f"Snapshot: {len(assignments)} account assignments.")
+        return assignments
+
+    @cached_property
+    def assignments_by_account(self):
+        index = defaultdict(list)
+        for assignment in self.assignments:
+            index[assignment["AccountId"]].append(assignment)
+        return index
+
+    @cached_property
+    def assignments_by_principal(self):
+        index = defaultdict(list)
+        for assignment in self.assignments:
+            index[assignment["PrincipalId"]].append(assignment)
+        return index
+
+    @cached_property
+    def groups(self):
+        # {GroupId: Group}
+        groups = self.table("groups", lambda: {group["GroupId"]: group for group in get_groups()})
+        for group_id, group in groups.items():
+            RESOLVER_CACHES["group"].put(group_id, group) # Listed groups answer later describe_group lookups too.
+        logger.info(f"Snapshot: {len(groups)} groups.")
+        return groups
+
+    @cached_property
+    def group_ids_by_name(self):
+        return {group["DisplayName"]: group_id for group_id, group in self.groups.items()}
+
+    @cached_property
+    def group_members(self):
+        # {GroupId: [UserId]}
+        return self.table("group_members", lambda: crawl_group_members(list(self.groups)))
+
+    @cached_property
+    def user_groups(self):
+        # {UserId: [GroupId]}
+        index = defaultdict(list)
+        for group_id, members in self.group_members.items():
+            for user_id in members:
+                index[user_id].append(group_id)
+        return index
+
+    @cached_property
+    def users(self):
+        # {UserId: User}
+        users = self.table("users", lambda: {user["UserId"]: user for user in get_users()})
+        for user_id, user in users.items():
+            RESOLVER_CACHES["user"].put(user_id, user)
+        logger.info(f"Snapshot: {len(users)} users.")
+        return users
+
+    @cached_property
+    def user_ids_by_name(self):
+        return {user["UserName"]: user_id for user_id, user in self.users.items()}
+
+    @cached_property
+    def access_index(self):
+        # Needs the full assignments and group_members tables (cheapest from the store, --offline).
+        return AccessIndex(self.assignments, self.group_members)
+
+    # Query planning
+    ## Each lookup below picks the cheapest route for the data it needs: a table that is already in memory (or in the
+    ## store when offline) costs nothing; otherwise a narrow API route (one account, one principal, a few describes
+    ## through the resolver cache) is used instead of crawling a whole table for a handful of rows.
+
+    SCOPED_ACCOUNT_LIMIT = 0.5 # Above this fraction of the org's accounts, crawling the whole assignments table is cheaper.
+    LIST_PAGE_SIZE = 100 # Entities returned by each list_groups / list_users call.
+
+    DERIVED_TABLES = {"assignments": "account_assignments", "account_assignments": "assignments"} # Either one in memory makes the other free.
+
+    def loaded(self, table):
+        return table in self.__dict__ or self.DERIVED_TABLES.get(table) in self.__dict__ or self.offline
+
+    def assignments_for_accounts(self, account_ids):
+        # {AccountId: [assignment]}
+        if self.loaded("assignments") or len(account_ids) > self.SCOPED_ACCOUNT_LIMIT * len(self.accounts):
+            return {account_id: self.assignments_by_account.get(account_id, []) for account_id in account_ids}
+        # Account-centric route: the permission sets provisioned to each account, then the assignments for each pair.
+        pairs = [
+            (permission_set, account_id)
+            for account_id, permission_sets in zip(account_ids, run_concurrently(lambda account_id: list(get_provisioned_permission_sets(account_id)), account_ids))
+            for permission_set in permission_sets
+        ]
+        assignments = {account_id: [] for account_id in account_ids}
+        for (permission_set, account_id), pair_assignments in crawl_account_assignments(pairs).items():
+            assignments[account_id].extend(pair_assignments)
+        return assignments
+
+    def assignments_for_principal(self, principal_id, principal_type):
+        # [assignment] for a group, or for a user including the assignments inherited through its groups.
+        if self.loaded("assignments") and (principal_type == "GROUP" or self.loaded("group_members")):
+            principal_ids = [principal_id] + (self.user_groups.get(principal_id, []) if principal_type == "USER" else [])
+            return [assignment for principal_id in principal_ids for assignment in self.assignments_by_principal.get(principal_id, [])]
+        return list(get_account_assignments_for_principal(principal_id, principal_type))
+
+    def permission_set_name(self, permission_set_arn):
+        if self.loaded("permission_sets"):
+            return self.permission_sets[permission_set_arn]
+        return get_permission_set_property(permission_set_arn, 'Name')
+
+    def group_id(self, group_name):
+        if self.loaded("groups"):
+            try:
+                return self.group_ids_by_name[group_name]
+            except KeyError:
+                raise Exception("Group or GroupId not found.")
+        return get_group_id("DisplayName", group_name)
+
+    def user_id(self, user_name):
+        if self.loaded("users"):
+            try:
+                return self.user_ids_by_name[user_name]
+            except KeyError:
+                raise Exception("User or UserId not found.")
+        return get_user_id("UserName", user_name)
+
+    def list_is_cheaper(self, table, describes):
+        # Listing a table costs one call per page, so it wins when there are more describes than pages. The size of the
+        # table is only known from the store (a previous run or refresh); with no size to go on, describe.
+        if not (self.store and self.store.has(table)):
+            return False
+        pages = max(1, -(-self.store.count(table) // self.LIST_PAGE_SIZE))
+        return describes > pages
+
+    def prefer_tables(self, group_ids=(), user_ids=()):
+        # Load the groups / users tables up front when that is cheaper than describing each of the IDs needed.
+        # Otherwise the describes are fanned out over the worker pool, so later principal() lookups hit the cache.
+        group_ids, user_ids = set(group_ids), set(user_ids)
+        if not self.loaded("groups") and group_ids:
+            if self.list_is_cheaper("groups", len(group_ids)):
+                self.groups
+            else:
+                run_concurrently(lambda group_id: self.principal(group_id, "GROUP"), group_ids)
+        if not self.loaded("users") and user_ids:
+            if self.list_is_cheaper("users", len(user_ids)):
+                self.users
+            else:
+                run_concurrently(lambda user_id: self.principal(user_id, "USER"), user_ids)
+
+    def group_members_for_groups(self, group_ids):
+        # {GroupId: [UserId]}. Each distinct group is expanded once per run, however many assignments it has.
+        if self.loaded("group_members"):
+            return {group_id: self.group_members.get(group_id, []) for group_id in group_ids}
+        members = self.__dict__.setdefault("scoped_group_members", {})
+        members.update(crawl_group_members([group_id for group_id in dict.fromkeys(group_ids) if group_id not in members]))
+        return {group_id: members[group_id] for group_id in group_ids}
+
+    def principal(self, PrincipalId, PrincipalType):
+        # Same shape as get_principal(): from the tables if loaded, otherwise described through the resolver cache.
+        if PrincipalType == "GROUP":
+            if not self.loaded("groups"):
+                try:
+                    group = describe_group(PrincipalId)
+                except idc_client.exceptions.ResourceNotFoundException:
+                    group = None
+            else:
+                group = self.groups.get(PrincipalId)
+            if group is None:
+                return {"PrincipalId": PrincipalId, "DisplayName": PrincipalType, "Description": "NOT FOUND"}
+            return {"PrincipalId": PrincipalId, "DisplayName": group["DisplayName"], "Description": group.get("Description", "")}
+        if not self.loaded("users"):
+            return get_principal(PrincipalId, PrincipalType)
+        user = self.users.get(PrincipalId)
+        if user is None:
+            return {"PrincipalId": PrincipalId, "DisplayName": PrincipalType, "Description": "NOT FOUND"}
+        return {"PrincipalId": PrincipalId, "DisplayName": user["DisplayName"], "Description": user["UserName"]}
+
+
+# Effective access
+## Who can reach which account with which permission set: direct USER assignments plus GROUP assignments expanded
+## through the group memberships, precomputed from one crawl. Users, groups, accounts, permission sets and grants
+## (account / permission set pairs) are interned to consecutive integers, and every set of them is a bitset held in a
+## Python int, so unions, intersections and differences are single big-integer operations. A user's grants are the
+## OR of its direct grants and its groups' grants; the users of each account and of each permission set are
+## precomputed. At 50,000 users a user set is about 6 KB, so even a large org stays in the tens of MB.
+
+class Interner:
+    # Value <-> consecutive integer ID.
+
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+
+    def intern(self, value):
+        id = self.ids.get(value)
+        if id is None:
+            id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return id
+
+    def __len__(self):
+        return len(self.values)
+
+def to_bitset(ids):
+    # Built in a bytearray, as OR-ing bits one at a time into a growing int is quadratic.
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        buffer[id >> 3] |= 1 << (id & 7)
+    return int.from_bytes(buffer, "little")
+
+BYTE_BITS = [[bit for bit in range(8) if byte >> bit & 1] for byte in range(256)]
+
+def bitset_ids(bitset):
+    # The set bits of bitset, in ascending order, decoded a byte at a time.
+    data = bitset.to_bytes((bitset.bit_length() + 7) // 8, "little")
+    return [offset * 8 + bit for offset, byte in enumerate(data) if byte for bit in BYTE_BITS[byte]]
+
+class AccessIndex:
+
+    def __init__(self, assignments, group_members):
+        start = time.perf_counter()
+        self.users = Interner()
+        self.groups = Interner()
+        self.accounts = Interner()
+        self.permission_sets = Interner()
+        self.grants = Interner() # Interned (account, permission set) pairs.
+
+        group_users = [] # group -> bitset of users
+        user_groups = defaultdict(list) # user -> [group]
+        for group_id, members in group_members.items():
+            group = self.groups.intern(group_id)
+            member_ids = [self.users.intern(user_id) for user_id in members]
+            group_users.append(to_bitset(member_ids))
+            for user in member_ids:
+                user_groups[user].append(group)
+
+        direct_grants = defaultdict(list) # user -> [grant]
+        group_grants = defaultdict(list) # group -> [grant]
+        grant_users = defaultdict(list) # grant -> [user], direct assignments only
+        grant_groups = defaultdict(list) # grant -> [group]
+        for assignment in assignments:
+            grant = self.grants.intern((self.accounts.intern(assignment["AccountId"]), self.permission_sets.intern(assignment["PermissionSetArn"])))
+            if assignment["PrincipalType"] == "USER":
+                user = self.users.intern(assignment["PrincipalId"])
+                direct_grants[user].append(grant)
+                grant_users[grant].append(user)
+            else:
+                group = self.groups.intern(assignment["PrincipalId"])
+                group_grants[group].append(grant)
+                grant_groups[grant].append(group)
+        group_users.extend(0 for _ in range(len(self.groups) - len(group_users))) # Assigned groups missing from group_members.
+
+        self.user_groups = [user_groups.get(user, []) for user in range(len(self.users))]
+        self.user_direct_grants = [to_bitset(direct_grants.get(user, [])) for user in range(len(self.users))]
+        self.group_grants = [to_bitset(group_grants.get(group, [])) for group in range(len(self.groups))]
+
+        # Users of each grant, rolled up per account and per permission set.
+        self.users_by_account = [0] * len(self.accounts)
+        self.users_by_permission_set = [0] * len(self.permission_sets)
+        grants_by_permission_set = defaultdict(list)
+        for grant, (account, permission_set) in enumerate(self.grants.values):
+            users = to_bitset(grant_users.get(grant, []))
+            for group in grant_groups.get(grant, []):
+                users |= group_users[group]
+            self.users_by_account[account] |= users
+            self.users_by_permission_set[permission_set] |= users
+            grants_by_permission_set[permission_set].append(grant)
+        self.grants_by_permission_set = [to_bitset(grants_by_permission_set[permission_set]) for permission_set in range(len(self.permission_sets))]
+        logger.info(f"Access index: {len(self.users)} users, {len(self.groups)} groups, {len(self.grants)} account / permission set grants, built in {time.perf_counter() - start:.2f}s.")
+
+    def user_grants(self, user_id):
+        # Bitset of the grants a user has, directly or through any of its groups.
+        user = self.users.ids.get(user_id)
+        if user is None:
+            return 0
+        grants = self.user_direct_grants[user]
+        for group in self.user_groups[user]:
+            grants |= self.group_grants[group]
+        return grants
+
+    def grant_pairs(self, grants):
+        # Bitset of grants -> [(AccountId, PermissionSetArn)]
+        return [
+            (self.accounts.values[account], self.permission_sets.values[permission_set])
+            for account, permission_set in (self.grants.values[grant] for grant in bitset_ids(grants))
+        ]
+
+    def user_access(self, user_id, permission_set_arn=None):
+        # [(AccountId, PermissionSetArn)] a user can use, optionally for one permission set only.
+        grants = self.user_grants(user_id)
+        if permission_set_arn is not None:
+            permission_set = self.permission_sets.ids.get(permission_set_arn)
+            grants &= self.grants_by_permission_set[permission_set] if permission_set is not None else 0
+        return self.grant_pairs(grants)
+
+    def user_accounts(self, user_id):
+        # [AccountId] a user can reach with any permission set.
+        return list(dict.fromkeys(account_id for account_id, _ in self.user_access(user_id)))
+
+    def account_users(self, account_id):
+        # [UserId] that can reach an account with any permission set.
+        account = self.accounts.ids.get(account_id)
+        return [self.users.values[user] for user in bitset_ids(self.users_by_account[account])] if account is not None else []
+
+    def permission_set_users(self, permission_set_arn):
+        # [UserId] that have a permission set in any account.
+        permission_set = self.permission_sets.ids.get(permission_set_arn)
+        return [self.users.values[user] for user in bitset_ids(self.users_by_permission_set[permission_set])] if permission_set is not None else []
+
+    def access_difference(self, user_id, other_user_id):
+        # ([(AccountId, PermissionSetArn)] only the first user has, [...] only the other user has).
+        grants, other_grants = self.user_grants(user_id), self.user_grants(other_user_id)
+        return self.grant_pairs(grants & ~other_grants), self.grant_pairs(other_grants & ~grants)
+
+
+# Policy index
+## Which permission sets allow an IAM action, from the policies the permission-set module attaches: the inline policy
+## and the AWS-managed policies (each document read once from IAM). Statements are indexed by action: exact actions in
+## a dict, "service:*" by service, and the other wildcards ("*", "*:Describe*", "ec2:Describe*") as case-insensitive
+## patterns, each tried once per query however many permission sets use it. A NotAction statement matches every action
+## its patterns don't. Resources and conditions are not evaluated: each grant carries its statement's resources and
+## whether it has a condition, and a Deny only rules a permission set out when it is unconditional and on every
+## resource (other Denies are reported next to the grants). Customer-managed policies live in the member accounts and
+## can't be read here, so permission sets attaching them are reported as not evaluated rather than left out.
+
+class ActionTable:
+    # Statement entries indexed by their action patterns, matched against concrete actions.
+
+    def __init__(self):
+        self.exact = defaultdict(list) # {"service:action": [entry]}
+        self.services = defaultdict(list) # {"service": [entry]} for "service:*"
+        self.patterns = defaultdict(list) # {pattern: [entry]} for every other wildcard
+        self.regexes = {} # {pattern: compiled}
+        self.not_actions = [] # [(compiled, entry)] for NotAction statements
+
+    @staticmethod
+    def compile(patterns):
+        # IAM wildcards: * is any run of characters, ? any one character. Actions are case-insensitive.
+        expressions = [re.escape(pattern).replace(r"\*", ".*").replace(r"\?", ".") for pattern in patterns]
+        return re.compile("|".join(f"(?:{expression})" for expression in expressions), re.IGNORECASE)
+
+    def add(self, pattern, entry):
+        pattern = pattern.lower()
+        service, _, action = pattern.partition(":")
+        if "*" not in pattern and "?" not in pattern:
+            self.exact[pattern].append(entry)
+        elif action == "*" and "*" not in service and "?" not in service:
+            self.services[service].append(entry)
+        else:
+            if pattern not in self.regexes:
+                self.regexes[pattern] = self.compile([pattern])
+            self.patterns[pattern].append(entry)
+
+    def add_not(self, patterns, entry):
+        self.not_actions.append((self.compile(patterns), entry))
+
+    def match(self, action):
+        action = action.lower()
+        entries = self.exact.get(action, []) + self.services.get(action.partition(":")[0], [])
+        for pattern, pattern_entries in self.patterns.items():
+            if self.regexes[pattern].fullmatch(action):
+                entries = entries + pattern_entries
+        return entries + [entry for regex, entry in self.not_actions if not regex.fullmatch(action)]
+
+class PolicyIndex:
+
+    def __init__(self, permission_set_policies, managed_policies):
+        self.allow = ActionTable()
+        self.deny = ActionTable()
+        self.unevaluated = defaultdict(list) # {PermissionSetArn: [policy name]}
+        for arn, policies in permission_set_policies.items():
+            if policies["inline"]:
+                self.add(arn, "inline", policies["inline"])
+            for policy in policies["managed"]:
+                if managed_policies.get(policy["Arn"]) is None:
+                    self.unevaluated[arn].append(policy["Name"])
+                else:
+                    self.add(arn, policy["Name"], managed_policies[policy["Arn"]])
+            for reference in policies["customer_managed"]:
+                self.unevaluated[arn].append(f"{reference.get('Path', '/')}{reference['Name']}")
+
+    @staticmethod
+    def as_list(value):
+        return value if isinstance(value, list) else [value]
+
+    def add(self, arn, policy_name, document):
+        for statement in self.as_list(document.get("Statement", [])):
+            effect = statement.get("Effect", "Allow")
+            table = self.allow if effect == "Allow" else self.deny
+            resources = self.as_list(statement["Resource"]) if "Resource" in statement else [f"NotResource {resource}" for resource in self.as_list(statement.get("NotResource", []))]
+            entry = {"permission_set": arn, "effect": effect, "policy": policy_name, "resources": resources, "conditional": "Condition" in statement}
+            if "NotAction" in statement:
+                patterns = self.as_list(statement["NotAction"])
+                table.add_not(patterns, {**entry, "action": f"NotAction {','.join(patterns)}"})
+            for pattern in self.as_list(statement.get("Action", [])):
+                table.add(pattern, {**entry, "action": pattern})
+
+    def permission_sets_for_action(self, action):
+        # {PermissionSetArn: [grant]} for the permission sets that may allow action. Grants are the matching Allow
+        # statements, then any matching Deny that doesn't rule the permission set out, then the policies not evaluated.
+        denies = defaultdict(list)
+        for entry in self.deny.match(action):
+            denies[entry["permission_set"]].append(entry)
+        denied = {arn for arn, entries in denies.items() if any(entry["resources"] == ["*"] and not entry["conditional"] for entry in entries)}
+        grants = defaultdict(list)
+        for entry in self.allow.match(action):
+            if entry["permission_set"] not in denied:
+                grants[entry["permission_set"]].append(entry)
+        for arn, policy_names in self.unevaluated.items():
+            if arn not in denied:
+                grants[arn].extend({"permission_set": arn, "effect": "Unknown", "policy": policy_name, "action": "not evaluated", "resources": [], "conditional": False} for policy_name in policy_names)
+        for arn in grants:
+            grants[arn].extend(denies.get(arn, []))
+        return dict(grants)
+
+
+# Group definitions
+## The group module (group/main.tf) expands team / role YAML into entitlement_map, one aws_ssoadmin_account_assignment
+## per group, permission set and account. The same expansion is reproduced here so `diff` can compare it with a crawl
+## instead of running `terraform plan`.
+
+def load_group_definitions(paths):
+    # Group YAML documents from files, or from every .yaml / .yml file under directories.
+    try:
+        import yaml
+    except ImportError:
+        raise Exception("diff needs the pyyaml package (pip install pyyaml).")
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(directory, file_name) for directory, _, file_names in os.walk(path)
+                for file_name in file_names if file_name.endswith((".yaml", ".yml"))
+            ))
+        else:
+            files.append(path)
+    definitions = []
+    for file in files:
+        with open(file) as f:
+            definitions.extend(definition for definition in yaml.safe_load_all(f) if definition)
+    logger.info(f"Loaded {len(definitions)} group definition(s) from {len(files)} file(s).")
+    return definitions
+
+def load_org_ou_account_map(path):
+    # org_ou_account_map from `terraform output -json org_ou_account_map`, or from `terraform output -json` (all outputs).
+    with open(path) as f:
+        data = json.load(f)
+    data = data.get("org_ou_account_map", data)
+    return data["value"] if "value" in data else data
+
+def expand_entitlements(definitions, org_ou_account_map):
+    # Returns (the group names defined, entitlement_map), as group/main.tf's group_role_map and entitlement_map:
+    # {"team_role_permissionset_account": {"group": "team_role", "account": account name, "permission_set": name}}.
+    groups = set()
+    entitlements = {}
+    for args in definitions:
+        team = args["team"]["name"]
+        account_set_map = {account_set["name"]: set(account_set["accounts"]) for account_set in args.get("account_sets") or []}
+        for role in args["roles"]:
+            group = f"{team}_{role['name']}"
+            groups.add(group)
+            for permission_set in role.get("permission_sets") or []:
+                accounts = []
+                for account_set in permission_set.get("account_sets") or []:
+                    if account_set not in account_set_map:
+                        raise Exception(f"Group {group}: account set '{account_set}' is not defined.")
+                    accounts.extend(sorted(account_set_map[account_set]))
+                for ou in permission_set.get("ous") or []:
+                    if ou not in org_ou_account_map["descendant_accounts"]:
+                        raise Exception(f"Group {group}: OU '{ou}' is not in the organisation.")
+                    accounts.extend(org_ou_account_map["descendant_accounts"][ou]["active"])
+                for account in accounts:
+                    entitlements[f"{group}_{permission_set['name']}_{account}"] = {"group": group, "account": account, "permission_set": permission_set["name"]}
+    return groups, entitlements
+
+
+# Commands
+## Each command returns its header and a generator of rows. Rows are answered from a Snapshot, which plans the API
+## route, and are produced as they are consumed so large reports can be written out without being held in memory.
+## Argument lookups (names to IDs) happen before the generator is returned, so bad arguments fail straight away.
+
+def list_entitlements(snapshot):
+    def rows():
+        if snapshot.loaded("account_assignments"):
+            snapshot.prefer_tables(
+                group_ids=[assignment["PrincipalId"] for assignment in snapshot.assignments if assignment["PrincipalType"] == "GROUP"],
+                user_ids=[assignment["PrincipalId"] for assignment in snapshot.assignments if assignment["PrincipalType"] == "USER"],
+            )
+        else:
+            # Rows are streamed as the assignments are crawled, before the principals they need are known. The crawl
+            # makes at least one call per permission set / account pair, so listing groups and users is cheap next to it.
+            snapshot.groups
+            snapshot.users
+        for assignment in snapshot.stream_assignments():
+            principal = snapshot.principal(assignment["PrincipalId"], assignment["PrincipalType"])
+            yield [
+                assignment["AccountId"],
+                snapshot.accounts[assignment["AccountId"]],
+                snapshot.permission_sets[assignment["PermissionSetArn"]],
+                assignment["PrincipalType"],
+                principal["DisplayName"],
+                principal["Description"],
+            ]
+    return ['account_id','account_name','permission_set_name','principal_type','principal_name','principal_description'], rows()
+
+def list_group_members(snapshot):
+    def rows():
+        snapshot.prefer_tables(user_ids=[user_id for members in snapshot.group_members.values() for user_id in members])
+        for group_id, group in snapshot.groups.items():
+            for user_id in snapshot.group_members[group_id]:
+                yield [group["DisplayName"], snapshot.principal(user_id, "USER")["Description"]]
+    return ['group_name','user_name'], rows()
+
+def get_groups_for_account(snapshot, account_names):
+    # account_names is a list of account names / IDs (a single command-line OPTION may be comma-separated).
+    # Rows come account by account, in the order of each account's assignments, not group by group.
+    account_ids = [get_account_id_from_name(account_name, snapshot.account_index) for account_name in account_names]
+    logger.info(f"account_ids: {account_ids}")
+    def rows():
+        assignments = snapshot.assignments_for_accounts(account_ids)
+        snapshot.prefer_tables(group_ids=[
+            assignment["PrincipalId"] for account_assignments in assignments.values()
+            for assignment in account_assignments if assignment["PrincipalType"] == "GROUP"
+        ])
+        for account_id in account_ids:
+            account_name = snapshot.accounts[account_id]
+            for assignment in assignments[account_id]:
+                if assignment["PrincipalType"] != "GROUP":
+                    continue
+                group_name = snapshot.principal(assignment["PrincipalId"], "GROUP")["DisplayName"]
+                permission_set_name = snapshot.permission_set_name(assignment["PermissionSetArn"])
+                logger.info(f"Group '{group_name}' has permission set '{permission_set_name}'.")
+                yield [account_id, account_name, group_name, permission_set_name]
+    return ['account_id','account_name','group','permission_set'], rows()
+
+def get_accounts_for_group(snapshot, group_name):
+    group_id = snapshot.group_id(group_name)
+    logger.debug("group_id: %s", group_id)
+    def rows():
+        for assignment in snapshot.assignments_for_principal(group_id, "GROUP"):
+            permission_set_name = snapshot.permission_set_name(assignment["PermissionSetArn"])
+            account_id = assignment["AccountId"]
+            logger.info(f"Can access account '{account_id}' ({snapshot.accounts[account_id]}) with permission set '{permission_set_name}'.")
+            yield [account_id, snapshot.accounts[account_id], group_name, permission_set_name]
+    return ['account_id','account_name','group','permission_set'], rows()
+
+def account_users(snapshot, account_ids, permission_set_arns=None):
+    # Yields (account_id, account_name, permission_set_arn, principal_type, group_name, user) for every user assigned to
+    # the accounts, directly or through a group, optionally only through the given permission sets.
+    assignments = {
+        account_id: [assignment for assignment in account_assignments if permission_set_arns is None or assignment["PermissionSetArn"] in permission_set_arns]
+        for account_id, account_assignments in snapshot.assignments_for_accounts(account_ids).items()
+    }
+    # Expand each distinct group once, then resolve every distinct user in bulk, before joining back to the assignments.
+    group_ids = {
+        assignment["PrincipalId"] for account_assignments in assignments.values()
+        for assignment in account_assignments if assignment["PrincipalType"] == "GROUP"
+    }
+    group_members = snapshot.group_members_for_groups(list(group_ids))
+    direct_user_ids = {
+        assignment["PrincipalId"] for account_assignments in assignments.values()
+        for assignment in account_assignments if assignment["PrincipalType"] == "USER"
+    }
+    logger.info(f"Expanding {len(group_ids)} distinct group(s).")
+    snapshot.prefer_tables(group_ids, direct_user_ids.union(*group_members.values()))
+    # The join (accounts x assignments x members) is the only part that can reach millions of rows, and is never materialised.
+    for account_id in account_ids:
+        account_name = snapshot.accounts[account_id]
+        logger.info(f"account_name, account_id: {account_name},{account_id}")
+        for assignment in assignments[account_id]:
+            if assignment['PrincipalType']=="GROUP":
+                group_name = snapshot.principal(assignment['PrincipalId'], "GROUP")["DisplayName"]
+                for user_id in group_members[assignment['PrincipalId']]:
+                    yield account_id, account_name, assignment["PermissionSetArn"], "GROUP", group_name, snapshot.principal(user_id, "USER")
+            elif assignment['PrincipalType']=="USER":
+                yield account_id, account_name, assignment["PermissionSetArn"], "USER", "N/A", snapshot.principal(assignment['PrincipalId'], "USER")
+
+def get_users_for_accounts(snapshot, account_names):
+    # account_names is a list of account names / IDs.
+    logger.info(f"Processing {len(account_names)} account(s).")
+    account_ids = [get_account_id_from_name(account_name, snapshot.account_index) for account_name in account_names]
+    def rows():
+        for account_id, account_name, permission_set_arn, principal_type, group_name, user in account_users(snapshot, account_ids):
+            yield [account_id, account_name, snapshot.permission_set_name(permission_set_arn), principal_type, group_name, user['Description'], user['DisplayName']]
+    return ['account_id','account_name','permission_set_name','principal_type','group_name','user_name','user_display_name'], rows()
+
+def get_users_for_action(snapshot, action, account_names=None):
+    # Every user who may perform an IAM action (e.g. iam:PassRole) in the accounts (default all), one row per user,
+    # account, permission set and policy statement granting (or partly denying) it. See PolicyIndex for the caveats.
+    account_ids = [get_account_id_from_name(account_name, snapshot.account_index) for account_name in account_names] if account_names else list(snapshot.accounts)
+    grants = snapshot.policy_index.permission_sets_for_action(action)
+    logger.info(f"{action} is allowed by {sum(any(grant['effect'] == 'Allow' for grant in permission_set_grants) for permission_set_grants in grants.values())} permission set(s), {len(grants)} including those with policies not evaluated.")
+    def rows():
+        for account_id, account_name, permission_set_arn, principal_type, group_name, user in account_users(snapshot, account_ids, grants):
+            permission_set_name = snapshot.permission_set_name(permission_set_arn)
+            for grant in grants[permission_set_arn]:
+                yield [
+                    account_id, account_name, permission_set_name, principal_type, group_name, user['Description'], user['DisplayName'],
+                    grant["effect"], grant["policy"], grant["action"], ",".join(grant["resources"]), "yes" if grant["conditional"] else "no",
+                ]
+    return ['account_id','account_name','permission_set_name','principal_type','group_name','user_name','user_display_name','effect','policy','statement_action','resources','conditional'], rows()
+
+def get_users_for_ou(snapshot, ou):
+    # Every user who can access an active account anywhere under the OU (name, path or ID), as get_users_for_accounts.
+    # Suspended accounts are left out, as the group module leaves them out when it expands an OU.
+    ou_id = snapshot.ou_index.resolve(ou)
+    account_ids = snapshot.ou_index.active(snapshot.ou_index.descendant_accounts(ou_id))
+    logger.info(f"OU {snapshot.org_tree[ou_id]['Path']}: {len(account_ids)} active account(s).")
+    return get_users_for_accounts(snapshot, account_ids)
+
+def get_permissions_for_user(snapshot, user_name):
+    user_id = snapshot.user_id(user_name)
+    logger.info(f"user_id: {user_id}")
+    def rows():
+        for assignment in snapshot.assignments_for_principal(user_id, "USER"):
+            if assignment['PrincipalType']=="GROUP":
+                group_name = snapshot.principal(assignment['PrincipalId'], "GROUP")["DisplayName"]
+            else:
+                group_name = "N/A"
+            account_id = assignment['AccountId']
+            yield [user_name, group_name, account_id, snapshot.accounts[account_id], snapshot.permission_set_name(assignment['PermissionSetArn'])]
+    return ['user_name','group_name','account_id','account_name','permission_set'], rows()
+
+def get_users_for_permission_set(snapshot, permission_set_name):
+    # Every user who has the permission set in any account, directly or through a group, from the access index.
+    permission_set_arns = [arn for arn, name in snapshot.permission_sets.items() if name == permission_set_name]
+    if not permission_set_arns:
+        raise Exception(f"Permission set {permission_set_name} not found.")
+    access = snapshot.access_index
+    def rows():
+        user_ids = {permission_set_arn: access.permission_set_users(permission_set_arn) for permission_set_arn in permission_set_arns}
+        snapshot.prefer_tables(user_ids=[user_id for users in user_ids.values() for user_id in users])
+        for permission_set_arn in permission_set_arns:
+            for user_id in user_ids[permission_set_arn]:
+                user = snapshot.principal(user_id, "USER")
+                yield [permission_set_name, user['Description'], user['DisplayName'], len(access.user_access(user_id, permission_set_arn))]
+    return ['permission_set','user_name','user_display_name','account_count'], rows()
+
+def compare_users(snapshot, user_names):
+    # The account / permission set pairs that only one of two users can use, from the access index.
+    if len(user_names) != 2:
+        raise Exception("compare-users needs two user names.")
+    user_ids = [snapshot.user_id(user_name) for user_name in user_names]
+    access = snapshot.access_index
+    def rows():
+        for user_name, only in zip(user_names, access.access_difference(*user_ids)):
+            for account_id, permission_set_arn in only:
+                yield [user_name, account_id, snapshot.accounts[account_id], snapshot.permission_sets[permission_set_arn]]
+    return ['only_user_name','account_id','account_name','permission_set'], rows()
+
+
+def diff(snapshot, definitions, org_ou_account_map=None):
+    # Drift between the group definitions and Identity Centre, from one bulk crawl (or the store, --offline):
+    # missing - defined but not assigned (detail says if the group, permission set or account doesn't exist),
+    # extra - assigned to a defined group but not defined,
+    # stale - defined and assigned, but the permission set has changed since it was last provisioned to the account.
+    # Groups that aren't in the definitions are left alone, as Terraform would.
+    uses_ous = any(permission_set.get("ous") for args in definitions for role in args["roles"] for permission_set in role.get("permission_sets") or [])
+    if org_ou_account_map is None and uses_ous:
+        org_ou_account_map = snapshot.org_ou_account_map
+    groups, entitlements = expand_entitlements(definitions, org_ou_account_map)
+    def rows():
+        group_ids = {group["DisplayName"]: group_id for group_id, group in snapshot.groups.items()}
+        permission_set_arns = {name: arn for arn, name in snapshot.permission_sets.items()}
+        account_ids = snapshot.account_index.ids_by_name
+        defined = {(entitlement["group"], entitlement["permission_set"], entitlement["account"]): key for key, entitlement in entitlements.items()}
+        assigned = {
+            (snapshot.groups[assignment["PrincipalId"]]["DisplayName"], snapshot.permission_sets[assignment["PermissionSetArn"]], snapshot.accounts[assignment["AccountId"]]): assignment
+            for assignment in snapshot.assignments
+            if assignment["PrincipalType"] == "GROUP" and snapshot.groups.get(assignment["PrincipalId"], {}).get("DisplayName") in groups
+        }
+        outdated = {(arn, account_id) for arn, outdated_account_ids in snapshot.outdated_permission_set_accounts.items() for account_id in outdated_account_ids}
+        drift = []
+        for entitlement in defined.keys() - assigned.keys():
+            group, permission_set, account = entitlement
+            absent = [f"{kind} does not exist" for kind, name, names in (("group", group, group_ids), ("permission set", permission_set, permission_set_arns), ("account", account, account_ids)) if name not in names]
+            drift.append(["missing", defined[entitlement], group, permission_set, account, ",".join(account_ids.get(account, [])), "; ".join(absent)])
+        for entitlement in assigned.keys() - defined.keys():
+            group, permission_set, account = entitlement
+            drift.append(["extra", f"{group}_{permission_set}_{account}", group, permission_set, account, assigned[entitlement]["AccountId"], ""])
+        for entitlement in defined.keys() & assigned.keys():
+            assignment = assigned[entitlement]
+            if (assignment["PermissionSetArn"], assignment["AccountId"]) in outdated:
+                group, permission_set, account = entitlement
+                drift.append(["stale", defined[entitlement], group, permission_set, account, assignment["AccountId"], "permission set not re-provisioned since it changed"])
+        counts = Counter(row[0] for row in drift)
+        logger.info(f"Drift: {len(entitlements)} defined entitlements, {counts['missing']} missing, {counts['extra']} extra, {counts['stale']} stale.")
+        yield from sorted(drift)
+    return ['status','entitlement','group','permission_set','account_name','account_id','detail'], rows()
+
+def refresh(store, max_age, name=None, shard=None):
+    # Re-crawl only the stale (or missing) entities in the store, or every entity belonging to one permission set,
+    # group or account when a name is given. With a shard (see in_shard()), only that shard's share is crawled.
+    # Returns the refreshed entities.
+    now = time.time()
+    accounts = get_account_map()
+    refreshed = []
+    def stale(captures, key):
+        return name is None and (key not in captures or now - captures[key] > max_age)
+    def refresh_table(table, crawl):
+        if table in SHARED_TABLES and not in_shard(None, shard):
+            return {}
+        if name is None and (not store.has(table) or now - store.captured_at(table) > max_age):
+            data = crawl()
+            store.save(table, data, now)
+            refreshed.append([table, "*", len(data)])
+        return store.load(table)
+
+    store.save("accounts", accounts, now)
+    if shard:
+        store.save("shard", {"index": shard[0], "count": shard[1], "by": shard[2]}, now)
+    permission_sets = refresh_table("permission_sets", crawl_permission_sets)
+    groups = refresh_table("groups", lambda: {group["GroupId"]: group for group in get_groups()})
+    refresh_table("users", lambda: {user["UserId"]: user for user in get_users()})
+    refresh_table("outdated_permission_set_accounts", lambda: crawl_permission_set_accounts(list(permission_sets), "LATEST_PERMISSION_SET_NOT_PROVISIONED"))
+    refresh_table("org_tree", crawl_org_tree)
+    policies = refresh_table("permission_set_policies", lambda: crawl_permission_set_policies(list(permission_sets)))
+    refresh_table("managed_policies", lambda: crawl_managed_policies(policies))
+
+    # Choose the entities to refresh: the stale ones, or the ones belonging to the named permission set / group / account.
+    permission_set_arns = [arn for arn, permission_set_name in permission_sets.items() if permission_set_name == name]
+    group_ids = [group_id for group_id, group in groups.items() if group["DisplayName"] == name]
+    account_index = AccountIndex(accounts)
+    is_account = name is not None and (name in accounts or name.casefold() in account_index.ids_by_folded_name)
+    account_ids = [account_index.resolve(name)] if is_account else []
+    if name is not None and not (permission_set_arns or group_ids or account_ids):
+        raise Exception(f"'{name}' is not a permission set, group or account name in the snapshot store.")
+
+    ## Accounts provisioned for each permission set (sharded by account, every shard needs them all to find its pairs)
+    shard_permission_sets = [arn for arn in permission_sets if shard_by(shard) != "permission-set" or in_shard(arn, shard)]
+    permission_set_arns = [arn for arn in permission_set_arns if arn in shard_permission_sets]
+    store.prune("permission_set_accounts", shard_permission_sets)
+    captures = store.captures("permission_set_accounts")
+    permission_set_arns.extend(arn for arn in shard_permission_sets if stale(captures, arn))
+    for arn, account_ids_for_arn in crawl_permission_set_accounts(permission_set_arns).items():
+        store.update("permission_set_accounts", arn, account_ids_for_arn, now)
+        refreshed.append(["permission_set_accounts", permission_sets[arn], len(account_ids_for_arn)])
+    # A named account's permission sets are listed from the account's side too, so one provisioned to it (or removed
+    # from it) since the last crawl is picked up without re-crawling every permission set.
+    stored_permission_set_accounts = store.load("permission_set_accounts")
+    for account_id in account_ids:
+        if shard_by(shard) == "account" and not in_shard(account_id, shard):
+            continue
+        provisioned = set(get_provisioned_permission_sets(account_id))
+        unknown = provisioned.difference(permission_sets)
+        if unknown:
+            logger.warning(f"{len(unknown)} permission set(s) provisioned to {accounts[account_id]} are not in the snapshot store, run a full refresh to add them.")
+        for arn in shard_permission_sets:
+            account_ids_for_arn = stored_permission_set_accounts.get(arn, [])
+            if (arn in provisioned) == (account_id in account_ids_for_arn):
+                continue
+            account_ids_for_arn = [other for other in account_ids_for_arn if other != account_id] + ([account_id] if arn in provisioned else [])
+            store.update("permission_set_accounts", arn, account_ids_for_arn, now)
+            refreshed.append(["permission_set_accounts", permission_sets[arn], len(account_ids_for_arn)])
+
+    ## Assignments for each permission set / account pair
+    pairs = [
+        (arn, account_id)
+        for arn, account_ids_for_arn in store.load("permission_set_accounts").items()
+        for account_id in account_ids_for_arn
+        if shard_by(shard) != "account" or in_shard(account_id, shard)
+    ]
+    store.prune("account_assignments", pairs)
+    captures = store.captures("account_assignments")
+    stale_pairs = [pair for pair in pairs if stale(captures, pair) or pair[0] in permission_set_arns or pair[1] in account_ids]
+    for pair, assignments in crawl_account_assignments(stale_pairs).items():
+        store.update("account_assignments", pair, assignments, now)
+        refreshed.append(["account_assignments", f"{permission_sets[pair[0]]} / {accounts.get(pair[1], pair[1])}", len(assignments)])
+
+    ## Members of each group
+    shard_groups = [group_id for group_id in groups if in_shard(group_id, shard)]
+    group_ids = [group_id for group_id in group_ids if group_id in shard_groups]
+    store.prune("group_members", shard_groups)
+    captures = store.captures("group_members")
+    group_ids.extend(group_id for group_id in shard_groups if stale(captures, group_id))
+    for group_id, members in crawl_group_members(group_ids).items():
+        store.update("group_members", group_id, members, now)
+        refreshed.append(["group_members", groups[group_id]["DisplayName"], len(members)])
+
+    logger.info(f"Refreshed {len(refreshed)} entities in {store.path}.")
+    return ['table','entity','entries'], refreshed
+
+# Shards
+## A crawl too big for one process can be split into SHARDS independent `refresh --shard I/N` runs (processes or
+## hosts), each writing its own store, and combined with `merge`. Shards split the permission set / account pairs by
+## permission set or by account, and the groups (for their members) by group. Entities are assigned to shards by a
+## hash of their ID, so every shard computes the same split without coordinating. The shared tables are crawled by
+## shard 0 only. The merged store holds each table in the order a single-process crawl would have written it, so
+## commands run --offline against it produce exactly the single-process output.
+
+SHARD_BY = ("permission-set", "account")
+SHARED_TABLES = ("users", "outdated_permission_set_accounts", "org_tree", "permission_set_policies", "managed_policies") # Crawled by shard 0 only.
+
+def parse_shard(text, by="permission-set"):
+    # "I/N" (0-based) to (I, N, by).
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"--shard must be I/N (e.g. 0/4), not '{text}'.")
+    if not 0 <= index < count:
+        raise ValueError(f"--shard {text}: I must be between 0 and N-1.")
+    if by not in SHARD_BY:
+        raise ValueError(f"--shard-by must be one of {', '.join(SHARD_BY)}.")
+    return index, count, by
+
+def in_shard(key, shard):
+    # Whether an entity (by ID) belongs to the shard. None is the shared tables, which belong to shard 0.
+    if shard is None:
+        return True
+    if key is None:
+        return shard[0] == 0
+    return zlib.crc32(key.encode()) % shard[1] == shard[0]
+
+def shard_by(shard):
+    return shard[2] if shard else None
+
+def merge(store, shard_paths):
+    # Combine the stores of a complete set of shards into store, replacing its tables. Entities found in more than
+    # one shard (every permission set's accounts, when sharded by account) are taken from the lowest shard index.
+    shards = {} # {index: (shard, SnapshotStore)}
+    for path in shard_paths:
+        if not os.path.exists(path):
+            raise Exception(f"Shard store {path} does not exist.")
+        shard_store = SnapshotStore(path)
+        shard = shard_store.load("shard")
+        if not shard:
+            raise Exception(f"{path} is not a shard store, crawl it with refresh --shard I/N.")
+        if shard["index"] in shards:
+            raise Exception(f"{path} and {shards[shard['index']][1].path} are both shard {shard['index']}.")
+        shards[shard["index"]] = (shard, shard_store)
+    count, by = shards[min(shards)][0]["count"], shards[min(shards)][0]["by"]
+    for shard, shard_store in shards.values():
+        if (shard["count"], shard["by"]) != (count, by):
+            raise Exception(f"{shard_store.path} is shard {shard['index']}/{shard['count']} by {shard['by']}, not one of {count} shards by {by}.")
+    missing = sorted(set(range(count)) - set(shards))
+    if missing:
+        raise Exception(f"Shards {', '.join(map(str, missing))} of {count} are missing.")
+    shard_stores = [shards[index][1] for index in sorted(shards)]
+    merged = []
+
+    def oldest(table):
+        return min(filter(None, (shard_store.captured_at(table) for shard_store in shard_stores)), default=None)
+    def keep(table, data):
+        store.save(table, data, oldest(table))
+        merged.append([table, len(data)])
+    def union(table, keys):
+        # {key: value} in the order of keys, from whichever shard has each entity.
+        entities = {}
+        for shard_store in reversed(shard_stores):
+            entities.update(shard_store.load(table))
+        missing = [key for key in keys if key not in entities]
+        if missing:
+            raise Exception(f"{len(missing)} {table} entities are in none of the shards (e.g. {missing[0]}), refresh the shards first.")
+        return {key: entities[key] for key in keys}
+
+    ## Shared tables as shard 0 crawled them, keyed tables in the order a single-process crawl would write them
+    for table in ("accounts", "permission_sets", "groups") + SHARED_TABLES:
+        if shard_stores[0].has(table):
+            keep(table, shard_stores[0].load(table))
+    permission_sets = shard_stores[0].load("permission_sets")
+    permission_set_accounts = union("permission_set_accounts", list(permission_sets))
+    keep("permission_set_accounts", permission_set_accounts)
+    keep("account_assignments", union("account_assignments", [
+        (arn, account_id) for arn, account_ids in permission_set_accounts.items() for account_id in account_ids
+    ]))
+    keep("group_members", union("group_members", list(shard_stores[0].load("groups"))))
+    logger.info(f"Merged {len(shard_stores)} shards into {store.path}.")
+    return ['table','entries'], merged
+
+def log_data_age(snapshot):
+    captured_at = snapshot.oldest_capture()
+    if captured_at is not None:
+        logger.info(f"Data captured at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(captured_at))} ({int(time.time() - captured_at)} seconds old).")
+
+
+# Output
+## Rows are written as the command produces them, so memory stays flat however long the report is, and a reader of
+## stdout (or of a growing file) sees rows before the crawl has finished. Besides the plain CSV, reports can be written
+## compressed, as JSON Lines, or as Parquet / Arrow for analytics tools. Every format except the plain CSV (kept as it
+## was for existing consumers) starts with a metadata block recording the command and when the data was captured.
+
+OUTPUT_PATH = "idc_helper.csv"
+OUTPUT_BUFFER = 1024 * 1024 # Bytes buffered between writes to the output file.
+OUTPUT_FORMATS = ("csv", "csv.gz", "csv.zst", "jsonl", "parquet", "arrow")
+DICTIONARY_COLUMNS = {"account_id", "account_name", "permission_set", "permission_set_name", "group", "group_name", "principal_type"}
+BATCH_ROWS = 65536 # Rows per Parquet / Arrow record batch.
+
+def output_path(format):
+    return OUTPUT_PATH if format == "csv" else f"idc_helper.{format}"
+
+def export_metadata(command, option, snapshot):
+    # When the data was captured: the oldest table the command read (from the store), or now for a live crawl.
+    now = time.time()
+    captured_at = snapshot.oldest_capture() or now
+    return {
+        "command": command,
+        "option": option,
+        "snapshot_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(captured_at)),
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)),
+    }
+
+@contextmanager
+def open_output(path, compression=None):
+    # Text stream writing to path ("-" is stdout), gzip- or zstd-compressed on the fly.
+    with ExitStack() as stack:
+        if path == "-":
+            sys.stdout.flush()
+            binary = sys.stdout.buffer
         else:
-            account_names=args[2].split(",")
-        logger.debug(f"account_names: {account_names}")
-        logger.info(f"Processing {len(account_names)} account(s).")
-        for account_name in account_names:
-            logger.info(f"account_name: {account_name}")
-            account_id=list(AWS_ACCOUNTS.keys())[list(AWS_ACCOUNTS.values()).index(account_name)] # Look up the Accounta dictionary in reverse to get the ID from the name.
-            logger.info(f"account_id: {account_id}")
-            provisioned_permission_sets=get_provisioned_permission_sets(account_id)
-            logger.debug(f"provisioned_permission_sets: {provisioned_permission_sets}")
-            for provisioned_permission_set in provisioned_permission_sets:
-                assignments=get_account_assignments(provisioned_permission_set,account_id)
-                logger.debug(f"assignments: {assignments}")
-                for assignment in assignments:
-                    logger.debug(f"PrincipalId: {assignment['PrincipalId']}")
-                    logger.info(f"PrincipalType: {assignment['PrincipalType']}")
-                    principal=get_principal(assignment['PrincipalId'], assignment['PrincipalType'])
-                    logger.info(f"principal: {principal['DisplayName']}")
-                    permission_set_name=get_permission_set_property(provisioned_permission_set,'Name')
-                    logger.info(f"permission_set_name: {permission_set_name}")
-                    if assignment['PrincipalType']=="GROUP":
-                        group_members=get_group_members(assignment['PrincipalId'])
-                        logger.debug(f"group_members: {group_members}")
-                        for group_member in group_members:
-                            logger.debug(f"group_member: {group_member}")
-                            logger.debug(f"UserId: {group_member['MemberId']['UserId']}")
-                            group_member_details=get_principal(group_member['MemberId']['UserId'], "USER")
-                            logger.debug(f"group_member_details: {group_member_details}")
-                            output=f"{account_id},{account_name},{permission_set_name},{assignment['PrincipalType']},{principal['DisplayName']},{group_member_details['Description']},{group_member_details['DisplayName']}"
-                            logger.info(output)
-                            f.write(output+'\n')
-                    elif assignment['PrincipalType']== "USER":
-                        user_details=get_principal(assignment['PrincipalId'], "USER")
-                        logger.debug(f"user_details: {user_details}")
-                        output=f"{account_id},{account_name},{permission_set_name},{assignment['PrincipalType']},N/A,{user_details['Description']},{user_details['DisplayName']}"
-                        logger.info(output)
-                        f.write(output+'\n')
-
-    elif args[1].lower()=="get-permissions-for-user":
-        f.write('user_name,group_name,account_id,account_name,permission_set\n')
-        user_name=args[2]
-        logger.info(f"user_name: {user_name}")
-        user_id=get_user_id("UserName",user_name)
-        logger.info(f"user_id: {user_id}")
-        account_assignments_for_principal=get_account_assignments_for_principal(user_id,'USER')
-        logger.debug(f"account_assignments_for_principal: {account_assignments_for_principal}")
-        for account_assignment_for_principal in account_assignments_for_principal:
-            logger.debug(f"account_assignment_for_principal: {account_assignment_for_principal}")
-            permission_set_name=get_permission_set_property(account_assignment_for_principal['PermissionSetArn'], 'Name')
-            logger.debug(f"permission_set_name: {permission_set_name}")
-            if account_assignment_for_principal['PrincipalType']=="GROUP":
-                group_name=get_group_property(account_assignment_for_principal["PrincipalId"],'DisplayName')
-                logger.debug(f"group_name: {group_name}")
+            binary = stack.enter_context(open(path, "wb", buffering=OUTPUT_BUFFER))
+        if compression == "gz":
+            binary = stack.enter_context(gzip.GzipFile(fileobj=binary, mode="wb"))
+        elif compression == "zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("--format csv.zst needs the zstandard package (pip install zstandard).")
+            binary = stack.enter_context(zstandard.ZstdCompressor().stream_writer(binary, closefd=False))
+        text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+        try:
+            yield text
+        finally:
+            text.flush()
+            text.detach()
+
+def write_rows(header, rows, path=OUTPUT_PATH, format="csv", metadata=None):
+    # Write rows in one of OUTPUT_FORMATS, returning the row count. metadata is called once the first row has been
+    # produced (so the tables the command loaded, and their capture times, are known) and returns a dict.
+    rows = iter(rows)
+    first_row = next(rows, None)
+    rows = chain([first_row], rows) if first_row is not None else iter(())
+    metadata = metadata() if metadata else {}
+    if format in ("parquet", "arrow"):
+        return write_arrow(header, rows, path, metadata, format)
+    with open_output(path, format.partition(".")[2] or None) as f:
+        if format == "jsonl":
+            return write_jsonl(header, rows, f, metadata)
+        return write_csv(header, rows, f, metadata if format != "csv" else None)
+
+def write_csv(header, rows, f, metadata=None):
+    # Fields containing commas, quotes or newlines are quoted. The metadata is a leading "# {json}" line.
+    if metadata:
+        f.write(f"# {json.dumps(metadata)}\n")
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow(header)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+def write_jsonl(header, rows, f, metadata):
+    # One object per row, keyed by column. The first line is {"_metadata": {...}}.
+    f.write(json.dumps({"_metadata": {**metadata, "columns": header}}) + "\n")
+    count = 0
+    for row in rows:
+        f.write(json.dumps(dict(zip(header, row))) + "\n")
+        count += 1
+    return count
+
+def write_arrow(header, rows, path, metadata, format):
+    # Parquet, or an Arrow IPC file, in batches of BATCH_ROWS. Account, permission set and group columns are
+    # dictionary-encoded: each distinct value is stored once, however many rows repeat it. The dictionaries only ever
+    # grow, so every batch after the first adds a delta rather than replacing them (Arrow IPC files require this).
+    # The metadata is stored in the schema, under b"idc_helper".
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception(f"--format {format} needs the pyarrow package (pip install pyarrow).")
+    if path == "-":
+        raise Exception(f"--format {format} can't be written to stdout, use --output PATH.")
+    dictionary_type = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    schema = pyarrow.schema(
+        [pyarrow.field(column, dictionary_type if column in DICTIONARY_COLUMNS else pyarrow.string()) for column in header],
+        metadata={b"idc_helper": json.dumps(metadata).encode()},
+    )
+    if format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression="zstd")
+    else:
+        writer = pyarrow.ipc.new_file(path, schema, options=pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+    dictionaries = {column: {} for column in header if column in DICTIONARY_COLUMNS} # {column: {value: index}}
+    count = 0
+    with writer:
+        while batch := list(islice(rows, BATCH_ROWS)):
+            arrays = []
+            for column, values in zip(header, zip(*batch)):
+                values = [str(value) for value in values]
+                if column in dictionaries:
+                    index = dictionaries[column]
+                    indices = [index.setdefault(value, len(index)) for value in values]
+                    arrays.append(pyarrow.DictionaryArray.from_arrays(pyarrow.array(indices, pyarrow.int32()), pyarrow.array(list(index), pyarrow.string())))
+                else:
+                    arrays.append(pyarrow.array(values, pyarrow.string()))
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+            count += len(batch)
+    return count
+
+
+# Importable API
+## For embedding the queries in other tools, e.g.
+##     from idc_helper import IdcHelper
+##     header, rows = IdcHelper(offline=True).get_accounts_for_group("team_role")
+## rows is a generator: iterate it once, or list() it. Constructing an IdcHelper doesn't call AWS. Only the tables a query needs are crawled (or read from the store).
+
+class IdcHelper:
+
+    COMMANDS = (
+        "list-entitlements",
+        "list-group-members",
+        "get-groups-for-account",
+        "get-accounts-for-group",
+        "get-permissions-for-user",
+        "get-users-for-accounts",
+        "get-users-for-ou",
+        "get-users-for-permission-set",
+        "get-users-for-action",
+        "compare-users",
+        "diff",
+        "refresh",
+        "merge",
+    )
+
+    def __init__(self, store_path=STORE_PATH, offline=False, session=None):
+        if session is not None:
+            set_session(session)
+        self.store = SnapshotStore(store_path) if store_path else None
+        if offline and self.store is None:
+            raise Exception("Offline mode needs a snapshot store.")
+        self.snapshot = Snapshot(self.store, offline=offline)
+
+    def list_entitlements(self, max_age=STALE_AFTER):
+        # An online crawl into a store is checkpointed, and resumes if an earlier run was interrupted.
+        if self.store is None or self.snapshot.offline:
+            return list_entitlements(self.snapshot)
+        self.snapshot.checkpoint = Checkpoint(self.store.path, max_age)
+        header, rows = list_entitlements(self.snapshot)
+        return header, checkpointed(rows, self.snapshot.checkpoint)
+
+    def list_group_members(self):
+        return list_group_members(self.snapshot)
+
+    def get_groups_for_account(self, account_names):
+        # account_names is a list of names or a comma-separated string.
+        if isinstance(account_names, str):
+            account_names=account_names.split(",")
+        return get_groups_for_account(self.snapshot, account_names)
+
+    def get_accounts_for_group(self, group_name):
+        return get_accounts_for_group(self.snapshot, group_name)
+
+    def get_permissions_for_user(self, user_name):
+        return get_permissions_for_user(self.snapshot, user_name)
+
+    def get_users_for_accounts(self, account_names):
+        # account_names is a list of names, a comma-separated string, or "all".
+        if isinstance(account_names, str):
+            if account_names.lower()=="all":
+                account_names=list(self.snapshot.accounts) # By ID, so accounts sharing a name are all included.
             else:
-                group_name="N/A"
-            output=f"{user_name},{group_name},{account_assignment_for_principal['AccountId']},{AWS_ACCOUNTS[account_assignment_for_principal['AccountId']]},{permission_set_name}"
-            logger.info(output)
-            f.write(output+'\n')
+                account_names=account_names.split(",")
+        return get_users_for_accounts(self.snapshot, account_names)
+
+    def get_users_for_ou(self, ou):
+        return get_users_for_ou(self.snapshot, ou)
+
+    def get_users_for_permission_set(self, permission_set_name):
+        return get_users_for_permission_set(self.snapshot, permission_set_name)
+
+    def get_users_for_action(self, action_and_accounts):
+        # "ACTION" or "ACTION,ACCOUNT,ACCOUNT" (or a list), e.g. "iam:PassRole,prod-account".
+        if isinstance(action_and_accounts, str):
+            action_and_accounts=action_and_accounts.split(",")
+        return get_users_for_action(self.snapshot, action_and_accounts[0], action_and_accounts[1:])
+
+    def policy_index(self):
+        # The PolicyIndex, for direct queries (e.g. policy_index().permission_sets_for_action("s3:DeleteBucket")).
+        return self.snapshot.policy_index
+
+    def compare_users(self, user_names):
+        # user_names is a list of two names or a comma-separated string.
+        if isinstance(user_names, str):
+            user_names=user_names.split(",")
+        return compare_users(self.snapshot, user_names)
+
+    def diff(self, paths, org_ou_account_map_path=None):
+        # paths is a list of group YAML files / directories, or a comma-separated string. The OU map (needed for
+        # definitions using ous) is read from a terraform output JSON file if given, otherwise crawled.
+        if isinstance(paths, str):
+            paths=paths.split(",")
+        org_ou_account_map = load_org_ou_account_map(org_ou_account_map_path) if org_ou_account_map_path else None
+        return diff(self.snapshot, load_group_definitions(paths), org_ou_account_map)
+
+    def access_index(self):
+        # The AccessIndex, for direct queries by ID (e.g. access_index().user_accounts(user_id)).
+        return self.snapshot.access_index
+
+    def refresh(self, max_age=STALE_AFTER, name=None, shard=None):
+        # shard is (index, count, by), see parse_shard().
+        if self.snapshot.offline:
+            raise Exception("refresh can't run --offline.")
+        return refresh(self.store, max_age, name, shard)
+
+    def merge(self, shard_paths):
+        # shard_paths is a list of shard store paths, or a comma-separated string.
+        if isinstance(shard_paths, str):
+            shard_paths=shard_paths.split(",")
+        return merge(self.store, shard_paths)
+
+    def run(self, command, option=None, max_age=STALE_AFTER, ou_map=None, shard=None):
+        # Dispatch a command-line command name. Returns (header, rows).
+        command = command.lower()
+        if command not in self.COMMANDS:
+            raise ValueError(f"Unknown command '{command}'.")
+        if command=="refresh":
+            return self.refresh(max_age, option, shard)
+        if shard is not None:
+            raise ValueError("--shard only applies to refresh (merge the shard stores, then run the command --offline).")
+        if command=="diff" and option is not None:
+            return self.diff(option, ou_map)
+        method = getattr(self, command.replace("-", "_"))
+        if command=="list-entitlements":
+            return method(max_age)
+        if command=="list-group-members":
+            return method()
+        if option is None:
+            raise ValueError(f"{command} requires an OPTION.")
+        return method(option)
+
+
+
+# Daemon
+## `serve` keeps a fully loaded snapshot in memory and answers the commands over HTTP, on a TCP port or a Unix socket,
+## so each question costs milliseconds instead of a process start and a crawl. A background thread refreshes the
+## store (only entities older than the refresh interval are re-crawled) and swaps in a freshly loaded snapshot;
+## requests in flight keep the snapshot they started with. Every response reports the age of the data.
+##     curl 'http://127.0.0.1:8787/get-accounts-for-group?option=team_role'
+##     curl --unix-socket /tmp/idc_helper.sock 'http://localhost/get-permissions-for-user?option=user@example.com'
+
+SERVE_ADDRESS = "127.0.0.1:8787"
+REFRESH_EVERY = 900 # Seconds between background refreshes of the daemon's snapshot.
+DAEMON_REFUSED = ("refresh", "merge", "diff") # Commands that write the store or read paths on the server, which clients must not choose.
+WARM_TABLES = ("accounts", "account_index", "permission_sets", "permission_set_accounts", "assignments", "assignments_by_account",
+    "assignments_by_principal", "groups", "group_ids_by_name", "group_members", "user_groups", "users", "user_ids_by_name", "access_index")
+
+class Daemon:
+
+    def __init__(self, store_path, refresh_every=REFRESH_EVERY, offline=False):
+        self.store_path = store_path
+        self.refresh_every = refresh_every
+        self.offline = offline
+        self.stopped = threading.Event()
+        self.helper = None
+
+    def load(self):
+        # A new IdcHelper answering from the store, with every table loaded (so requests never touch the store or AWS).
+        helper = IdcHelper(self.store_path, offline=True)
+        tables = WARM_TABLES
+        if helper.store.has("outdated_permission_set_accounts"):
+            tables += ("outdated_permission_set_accounts",)
+        if helper.store.has("org_tree"):
+            tables += ("org_tree", "ou_index")
+        if helper.store.has("permission_set_policies") and helper.store.has("managed_policies"):
+            tables += ("policy_index",)
+        for table in tables:
+            getattr(helper.snapshot, table)
+        self.helper = helper
+        logger.info(f"Serving data captured {self.data_age(helper)} seconds ago.")
+
+    def refresh(self, max_age=0):
+        # Re-crawl everything captured more than max_age seconds ago (by default, everything), then swap it in.
+        get_account_map.cache_clear()
+        get_account_details.cache_clear()
+        get_account_index.cache_clear()
+        refresh(SnapshotStore(self.store_path), max_age)
+        self.load()
 
+    def refresh_loop(self, catch_up=False):
+        # Catching up after serving a store from a previous run only re-crawls what is older than the interval.
+        while catch_up or not self.stopped.wait(self.refresh_every):
+            try:
+                self.refresh(self.refresh_every if catch_up else 0)
+            except Exception:
+                logger.exception("Background refresh failed, still serving the previous snapshot.")
+            catch_up = False
+
+    def start(self):
+        # Serve from the store straight away if it has everything, otherwise refresh it first.
+        from_store = self.offline or all(SnapshotStore(self.store_path).has(table) for table in ("accounts", "permission_sets", "account_assignments", "groups", "group_members", "users"))
+        if from_store:
+            self.load()
+        else:
+            self.refresh()
+        if not self.offline:
+            threading.Thread(target=self.refresh_loop, args=(from_store,), daemon=True).start()
+
+    @staticmethod
+    def data_age(helper):
+        captured_at = helper.snapshot.oldest_capture()
+        return int(time.time() - captured_at) if captured_at else None
+
+    def answer(self, command, option):
+        # (HTTP status, response body) for one command.
+        helper = self.helper
+        body = {"command": command, "option": option}
+        try:
+            if command == "health":
+                status = 200
+            elif command not in helper.COMMANDS:
+                status, body["error"] = 404, f"Unknown command '{command}'."
+            elif command in DAEMON_REFUSED:
+                status, body["error"] = 403, f"{command} is not served by the daemon, run it with idc_helper.py instead."
+            else:
+                header, rows = helper.run(command, option)
+                status, body["header"], body["rows"] = 200, header, list(rows)
+                API_METRICS.rows[command] += len(body["rows"])
+        except Exception as e:
+            status, body["error"] = 400, str(e)
+        captured_at = helper.snapshot.oldest_capture()
+        body["captured_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(captured_at)) if captured_at else None
+        body["data_age_seconds"] = self.data_age(helper)
+        return status, body
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    # GET /COMMAND?option=OPTION -> {"header", "rows", "captured_at", "data_age_seconds"} (or {"error"}). GET /health.
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        status, body = self.server.idc_daemon.answer(url.path.strip("/").lower(), parse_qs(url.query).get("option", [None])[0])
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("X-Data-Age-Seconds", str(body["data_age_seconds"]))
+        self.end_headers()
+        self.wfile.write(payload)
+        logger.info(f"{self.path} -> {status} in {(time.perf_counter() - start) * 1000:.1f} ms.")
+
+    def log_message(self, format, *args):
+        # Requests are logged by do_GET. (The default also breaks on Unix socket client addresses.)
+        logger.debug(format, *args)
+
+class DaemonHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 128 # Bursts of clients, e.g. a bot fanning out lookups.
+
+class DaemonUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def parse_serve_address(address):
+    # HOST:PORT to (host, port), or a Unix socket path (anything with a "/") to itself. A stale socket left by an
+    # earlier daemon is removed, but never any other kind of file: "serve idc_helper.db" must not delete the store.
+    if "/" in address:
+        try:
+            mode = os.stat(address).st_mode
+        except FileNotFoundError:
+            return address
+        if not stat.S_ISSOCK(mode):
+            raise ValueError(f"{address} exists and is not a Unix socket, choose another socket path.")
+        os.remove(address)
+        return address
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"serve needs HOST:PORT (e.g. {SERVE_ADDRESS}) or a Unix socket path containing a / (e.g. ./idc_helper.sock), not '{address}'.")
+    return host, int(port)
+
+def serve(address=SERVE_ADDRESS, store_path=STORE_PATH, refresh_every=REFRESH_EVERY, offline=False):
+    # address is HOST:PORT, or the path of a Unix socket.
+    server_address = parse_serve_address(address)
+    daemon = Daemon(store_path, refresh_every, offline)
+    daemon.start()
+    if isinstance(server_address, tuple):
+        server = DaemonHTTPServer(server_address, DaemonRequestHandler)
     else:
+        server = DaemonUnixHTTPServer(server_address, DaemonRequestHandler)
+    server.idc_daemon = daemon
+    logger.info(f"Serving on {address}.")
+    try:
+        server.serve_forever()
+    finally:
+        daemon.stopped.set()
+        server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(usage="python idc_helper.py COMMAND [OPTION] [--workers N] [--rate N] [--cache-size N] [--cache-ttl SECONDS] [--store PATH] [--offline] [--max-age SECONDS] [--metrics PATH] [--progress SECONDS] [--output PATH] [--format FORMAT] [--ou-map PATH] [--refresh-every SECONDS] [--shard I/N] [--shard-by permission-set|account]", add_help=False)
+    parser.add_argument("command", nargs="?", default="help")
+    parser.add_argument("option", nargs="?")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Number of concurrent API calls.")
+    parser.add_argument("--rate", type=float, default=API_RATE, help="Maximum requests per second for each API operation.")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, help="Maximum entries in each resolver cache.")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL, help="Seconds before a cached lookup expires.")
+    parser.add_argument("--store", default=STORE_PATH, help="Path of the SQLite snapshot store.")
+    parser.add_argument("--offline", action="store_true", help="Answer from the snapshot store without calling AWS.")
+    parser.add_argument("--max-age", type=float, default=STALE_AFTER, help="Seconds before refresh considers an entity stale.")
+    parser.add_argument("--metrics", help="Write run metrics to this file (Prometheus textfile if it ends in .prom, JSON otherwise).")
+    parser.add_argument("--progress", type=float, help="Log a progress line with estimated time remaining every N seconds.")
+    parser.add_argument("--output", help="Path of the report (default idc_helper.<format>), or - for stdout.")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv", help="Report format.")
+    parser.add_argument("--ou-map", help="org_ou_account_map as terraform output JSON, for diff (default: crawl the organisation).")
+    parser.add_argument("--refresh-every", type=float, default=REFRESH_EVERY, help="Seconds between the serve daemon's background refreshes.")
+    parser.add_argument("--shard", help="For refresh: crawl only shard I of N (I/N, 0-based) into the store, for merge.")
+    parser.add_argument("--shard-by", choices=SHARD_BY, default="permission-set", help="Split shards by permission set or by account.")
+    args = parser.parse_args()
+    configure_concurrency(args.workers, args.rate)
+    configure_cache(args.cache_size, args.cache_ttl)
+    if args.command.lower() not in IdcHelper.COMMANDS + ("serve",):
         print(__doc__)
+        quit()
+    configure_logging()
+    if args.progress:
+        PROGRESS.report_every(args.progress)
+    if args.command.lower()=="serve":
+        serve(args.option or SERVE_ADDRESS, args.store, args.refresh_every, args.offline)
+        quit()
+    helper = IdcHelper(args.store, offline=args.offline)
+    shard = parse_shard(args.shard, args.shard_by) if args.shard else None
+    header, rows = helper.run(args.command, args.option, max_age=args.max_age, ou_map=args.ou_map, shard=shard)
+
+    def logged(rows):
+        for row in rows:
+            logger.info(",".join(str(value) for value in row))
+            yield row
+    API_METRICS.rows[args.command.lower()] += write_rows(
+        header, logged(rows), args.output or output_path(args.format), args.format,
+        metadata=lambda: export_metadata(args.command.lower(), args.option, helper.snapshot),
+    )
 
-    f.close()
+    log_data_age(helper.snapshot)
+    log_cache_stats()
+    API_METRICS.log_summary()
+    if args.metrics:
+        API_METRICS.write(args.metrics)
@@ -0,0 +1,427 @@
+# Tests for idc_helper.py. Commands are checked against the synthetic organisation in idc_fake_backend.py, which
+# complements the call counts and timings idc_benchmark.py compares. Run with `python -m pytest` from this directory.
+import csv
+import gzip
+import io
+import json
+import random
+import re
+import socket
+import traceback
+
+import botocore.exceptions
+import pytest
+
+import idc_fake_backend
+import idc_helper
+
+# Resolver cache
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(idc_helper, "CACHE_SIZE", 3)
+    monkeypatch.setattr(idc_helper, "CACHE_TTL", 60)
+    return idc_helper.ResolverCache("test")
+
+def test_cache_evicts_least_recently_used_and_expires(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(idc_helper.time, "monotonic", lambda: now[0])
+    for key in "abc":
+        cache.get(key, lambda: key.upper())
+    assert cache.get("a", lambda: "reloaded") == "A"
+    cache.get("d", lambda: "D")
+    assert list(cache.entries) == ["c", "a", "d"] and cache.evictions == 1
+    now[0] += 61
+    assert cache.get("a", lambda: "reloaded") == "reloaded"
+    assert (cache.hits, cache.misses) == (1, 5)
+
+def test_cache_raises_a_fresh_not_found_on_every_negative_hit(cache):
+    calls = []
+    def loader():
+        calls.append(1)
+        raise idc_fake_backend.ResourceNotFoundException("DescribeUser", "User not found")
+    errors = []
+    for _ in range(50):
+        with pytest.raises(idc_fake_backend.ResourceNotFoundException) as raised:
+            cache.get("deleted", loader, not_found=idc_fake_backend.ResourceNotFoundException)
+        errors.append(raised.value)
+    assert len(calls) == 1 and cache.negative_hits == 49
+    assert len({id(error) for error in errors}) == 50
+    assert errors[-1].response == errors[0].response and errors[-1].operation_name == "DescribeUser"
+    assert len(traceback.extract_tb(errors[-1].__traceback__)) == len(traceback.extract_tb(errors[1].__traceback__))
+
+# Snapshot store
+def test_store_file_is_only_created_by_the_first_write(backend, tmp_path):
+    store = tmp_path / "idc_helper.db"
+    with pytest.raises(Exception, match="not in the snapshot store"):
+        run(str(store), "list-entitlements", offline=True)
+    assert not store.exists()
+    run(str(store), "get-accounts-for-group", next(iter(backend.groups.values()))["DisplayName"])
+    assert store.exists()
+    assert run(str(store), "list-entitlements") == run(str(store), "list-entitlements", offline=True)
+
+# Planner
+def test_list_is_cheaper_only_with_a_known_table_size(tmp_path):
+    assert not idc_helper.Snapshot().list_is_cheaper("users", 10000)
+    store = idc_helper.SnapshotStore(str(tmp_path / "idc_helper.db"))
+    snapshot = idc_helper.Snapshot(store)
+    assert not snapshot.list_is_cheaper("users", 10000)
+    store.save("users", {f"user-{i}": {"UserName": f"user-{i}"} for i in range(250)})
+    assert not snapshot.list_is_cheaper("users", 3)
+    assert snapshot.list_is_cheaper("users", 4)
+    store.save("groups", {})
+    assert snapshot.list_is_cheaper("groups", 2) and not snapshot.list_is_cheaper("groups", 1)
+
+def test_loaded_account_assignments_answer_later_commands(backend):
+    idc_helper.reset_state()
+    helper = idc_helper.IdcHelper(None)
+    list(helper.run("list-entitlements")[1])
+    backend.reset_calls()
+    rows = list(helper.run("get-groups-for-account", next(iter(backend.accounts)))[1])
+    assert rows and sum(backend.calls.values()) == 0
+
+# Account index
+def test_account_index_resolves_ids_names_and_case_insensitive_names():
+    index = idc_helper.AccountIndex({"111111111111": "Prod", "222222222222": "Staging", "333333333333": "staging"})
+    assert index.resolve("111111111111") == "111111111111"
+    assert index.resolve("Prod") == "111111111111"
+    assert index.resolve("PROD") == "111111111111"
+    assert index.resolve("Staging") == "222222222222" # An exact name wins over a case-insensitive match.
+    assert index.resolve("staging") == "333333333333"
+    assert index.name("222222222222") == "Staging"
+
+def test_account_index_refuses_ambiguous_and_unknown_names():
+    index = idc_helper.AccountIndex({"111111111111": "shared", "222222222222": "shared", "333333333333": "Staging", "444444444444": "staging"})
+    with pytest.raises(Exception, match="ambiguous.*111111111111, 222222222222"):
+        index.resolve("shared")
+    with pytest.raises(Exception, match="ambiguous.*333333333333, 444444444444"):
+        index.resolve("STAGING")
+    with pytest.raises(Exception, match="not found"):
+        index.resolve("missing")
+
+@pytest.fixture
+def backend():
+    backend = idc_fake_backend.FakeBackend(accounts=60, groups=120, users=800, permission_sets=16, seed=3)
+    idc_helper.set_session(idc_fake_backend.FakeSession(backend))
+    idc_helper.configure_concurrency(8, 100000)
+    yield backend
+    idc_helper.set_session(None)
+
+def run(store, command, option=None, offline=False, **kwargs):
+    # (header, rows) of a command, from a cold module as in a new process.
+    idc_helper.reset_state()
+    header, rows = idc_helper.IdcHelper(store, offline=offline).run(command, option, **kwargs)
+    return header, list(rows)
+
+# OU paths
+def test_offline_account_ou_paths_come_from_the_store(backend, tmp_path):
+    store = str(tmp_path / "store.db")
+    run(store, "refresh")
+    idc_helper.reset_state()
+    backend.reset_calls()
+    index = idc_helper.Snapshot(idc_helper.SnapshotStore(store), offline=True).account_index
+    paths = {account_id: index.ou_path(account_id) for account_id in backend.accounts}
+    assert sum(backend.calls.values()) == 0
+    live = idc_helper.OuIndex(idc_helper.crawl_org_tree())
+    assert paths == {account_id: live.account_path(account_id) for account_id in backend.accounts}
+    assert len(set(paths.values())) > 1
+
+# Commands
+## Every command's rows are compared with a naive join over the fake backend's data, made the way the original script
+## made them: one describe per principal, and the rows in the order its API calls listed them.
+
+def principal(backend, principal_id, principal_type):
+    # (DisplayName, Description) as get_principal() reports them.
+    if principal_type == "GROUP":
+        group = backend.groups[principal_id]
+        return group["DisplayName"], group.get("Description", "")
+    user = backend.users.get(principal_id)
+    return (user["DisplayName"], user["UserName"]) if user else ("USER", "NOT FOUND")
+
+def expected_rows(backend, command, option):
+    accounts = {account_id: account["Name"] for account_id, account in backend.accounts.items()}
+    account_ids = {name: account_id for account_id, name in accounts.items()}
+    permission_sets = {arn: permission_set["Name"] for arn, permission_set in backend.permission_sets.items()}
+    groups = {group_id: group["DisplayName"] for group_id, group in backend.groups.items()}
+    rows = []
+    if command == "list-entitlements":
+        for arn in backend.permission_sets:
+            for account_id in backend.provisioned[arn]:
+                for assignment in backend.assignments[(arn, account_id)]:
+                    rows.append([account_id, accounts[account_id], permission_sets[arn], assignment["PrincipalType"], *principal(backend, assignment["PrincipalId"], assignment["PrincipalType"])])
+    elif command == "list-group-members":
+        for group_id in backend.groups:
+            for user_id in backend.members[group_id]:
+                rows.append([groups[group_id], principal(backend, user_id, "USER")[1]])
+    elif command == "get-groups-for-account":
+        for group_id in backend.groups:
+            for assignment in backend.assignments_by_principal[group_id]:
+                if assignment["AccountId"] == account_ids[option]:
+                    rows.append([assignment["AccountId"], option, groups[group_id], permission_sets[assignment["PermissionSetArn"]]])
+    elif command == "get-accounts-for-group":
+        group_id = next(group_id for group_id, name in groups.items() if name == option)
+        for assignment in backend.assignments_by_principal[group_id]:
+            rows.append([assignment["AccountId"], accounts[assignment["AccountId"]], option, permission_sets[assignment["PermissionSetArn"]]])
+    elif command == "get-permissions-for-user":
+        user_id = next(user_id for user_id, user in backend.users.items() if user["UserName"] == option)
+        for principal_id in [user_id] + backend.memberships[user_id]:
+            for assignment in backend.assignments_by_principal[principal_id]:
+                group_name = groups[principal_id] if assignment["PrincipalType"] == "GROUP" else "N/A"
+                rows.append([option, group_name, assignment["AccountId"], accounts[assignment["AccountId"]], permission_sets[assignment["PermissionSetArn"]]])
+    elif command == "get-users-for-accounts":
+        for account_id in (list(accounts) if option == "all" else [account_ids[name] for name in option.split(",")]):
+            for arn in backend.provisioned_to_account[account_id]:
+                for assignment in backend.assignments[(arn, account_id)]:
+                    if assignment["PrincipalType"] == "GROUP":
+                        for user_id in backend.members[assignment["PrincipalId"]]:
+                            display_name, user_name = principal(backend, user_id, "USER")
+                            rows.append([account_id, accounts[account_id], permission_sets[arn], "GROUP", groups[assignment["PrincipalId"]], user_name, display_name])
+                    else:
+                        display_name, user_name = principal(backend, assignment["PrincipalId"], "USER")
+                        rows.append([account_id, accounts[account_id], permission_sets[arn], "USER", "N/A", user_name, display_name])
+    return rows
+
+COMMAND_CASES = {
+    "list-entitlements": lambda backend: None,
+    "list-group-members": lambda backend: None,
+    # The first account has the assignment to a deleted user.
+    "get-groups-for-account": lambda backend: backend.accounts[min(backend.accounts)]["Name"],
+    "get-accounts-for-group": lambda backend: backend.groups[max(backend.groups, key=lambda group_id: len(backend.assignments_by_principal[group_id]))]["DisplayName"],
+    "get-permissions-for-user": lambda backend: backend.users[max(backend.users, key=lambda user_id: len(backend.memberships[user_id]))]["UserName"],
+    "get-users-for-accounts": lambda backend: ",".join(backend.accounts[account_id]["Name"] for account_id in sorted(backend.accounts)[:3]),
+    "get-users-for-accounts-all": lambda backend: "all",
+}
+
+@pytest.mark.parametrize("offline", [False, True], ids=["live", "offline"])
+@pytest.mark.parametrize("case", COMMAND_CASES)
+def test_command_matches_naive_join(backend, tmp_path, case, offline):
+    command, option = case.removesuffix("-all"), COMMAND_CASES[case](backend)
+    store = str(tmp_path / "store.db")
+    if offline:
+        run(store, "refresh")
+    header, rows = run(store, command, option, offline=offline)
+    expected = expected_rows(backend, command, option)
+    assert rows
+    if command == "get-groups-for-account":
+        # Answered account by account rather than group by group, so only the order differs.
+        rows, expected = sorted(rows), sorted(expected)
+    assert rows == expected
+
+# Output
+def read_report(path, format):
+    # (metadata, header, rows) of a report written by write_rows().
+    if format in ("parquet", "arrow"):
+        pyarrow = pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path) if format == "parquet" else pyarrow.ipc.open_file(path).read_all()
+        rows = [list(row) for row in zip(*(column.to_pylist() for column in table.columns))]
+        return json.loads(table.schema.metadata[b"idc_helper"]), table.column_names, rows
+    if format == "csv.zst":
+        zstandard = pytest.importorskip("zstandard")
+        f = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8", newline="")
+    elif format == "csv.gz":
+        f = gzip.open(path, "rt", encoding="utf-8", newline="")
+    else:
+        f = open(path, encoding="utf-8", newline="")
+    with f:
+        if format == "jsonl":
+            lines = [json.loads(line) for line in f]
+            metadata = lines[0]["_metadata"]
+            header = metadata.pop("columns")
+            return metadata, header, [[line[column] for column in header] for line in lines[1:]]
+        metadata = json.loads(f.readline()[2:]) if format != "csv" else None
+        header, *rows = csv.reader(f)
+        return metadata, header, rows
+
+@pytest.mark.parametrize("format", idc_helper.OUTPUT_FORMATS)
+def test_report_round_trips_in_every_format(backend, tmp_path, format):
+    header, rows = run(None, "list-entitlements")
+    assert any("," in field for row in rows for field in row) # Some fake group descriptions have commas.
+    rows.append(["111111111111", 'account "one", prod', "PermissionSet\nwith a newline", "USER", "User", "NOT FOUND"])
+    metadata = {"command": "list-entitlements", "option": None, "snapshot_time": "2026-01-01T00:00:00Z"}
+    path = str(tmp_path / f"report.{format}")
+    assert idc_helper.write_rows(header, iter(rows), path, format, lambda: metadata) == len(rows)
+    assert read_report(path, format) == (metadata if format != "csv" else None, header, rows)
+
+# Effective-access index
+def test_access_index_matches_brute_force_join(backend):
+    snapshot = idc_helper.Snapshot()
+    index = idc_helper.AccessIndex(snapshot.assignments, snapshot.group_members)
+    access = {} # {UserId: {(AccountId, PermissionSetArn)}}
+    for assignment in snapshot.assignments:
+        users = [assignment["PrincipalId"]] if assignment["PrincipalType"] == "USER" else snapshot.group_members.get(assignment["PrincipalId"], [])
+        for user_id in users:
+            access.setdefault(user_id, set()).add((assignment["AccountId"], assignment["PermissionSetArn"]))
+    account_users, permission_set_users = {}, {}
+    for user_id, grants in access.items():
+        assert set(index.user_access(user_id)) == grants
+        for account_id, arn in grants:
+            account_users.setdefault(account_id, set()).add(user_id)
+            permission_set_users.setdefault(arn, set()).add(user_id)
+    for account_id, users in account_users.items():
+        assert set(index.account_users(account_id)) == users
+    for arn, users in permission_set_users.items():
+        assert set(index.permission_set_users(arn)) == users
+    rng = random.Random(0)
+    for _ in range(50):
+        first, second = rng.sample(sorted(access), 2)
+        only_first, only_second = index.access_difference(first, second)
+        assert (set(only_first), set(only_second)) == (access[first] - access[second], access[second] - access[first])
+
+# Diff
+@pytest.mark.parametrize("drift", [0.0, 0.1])
+def test_diff_matches_a_naive_comparison(backend, tmp_path, drift):
+    yaml = pytest.importorskip("yaml")
+    definitions = backend.group_definitions(drift)
+    for index, definition in enumerate(definitions):
+        (tmp_path / f"group{index}.yaml").write_text(yaml.safe_dump(definition))
+
+    ## Expand the definitions into (group, permission set, account name) and compare them with the fake's assignments.
+    defined = set()
+    for definition in definitions:
+        account_sets = {account_set["name"]: account_set["accounts"] for account_set in definition["account_sets"]}
+        for role in definition["roles"]:
+            group = f"{definition['team']['name']}_{role['name']}"
+            for permission_set in role["permission_sets"]:
+                for account_set in permission_set["account_sets"]:
+                    defined.update((group, permission_set["name"], account) for account in account_sets[account_set])
+    defined_groups = {group for group, _, _ in defined}
+    assigned = {}
+    for (arn, account_id), assignments in backend.assignments.items():
+        for assignment in assignments:
+            group = backend.groups[assignment["PrincipalId"]]["DisplayName"] if assignment["PrincipalType"] == "GROUP" else None
+            if group in defined_groups:
+                assigned[(group, backend.permission_sets[arn]["Name"], backend.accounts[account_id]["Name"])] = (arn, account_id)
+    expected = (
+        {("missing", *entitlement) for entitlement in defined - assigned.keys()}
+        | {("extra", *entitlement) for entitlement in assigned.keys() - defined}
+        | {("stale", *entitlement) for entitlement in defined & assigned.keys() if assigned[entitlement] in backend.outdated}
+    )
+    assert any(status == "stale" for status, *_ in expected)
+    assert any(status != "stale" for status, *_ in expected) == bool(drift)
+
+    header, rows = run(None, "diff", str(tmp_path))
+    assert {(row[0], row[2], row[3], row[4]) for row in rows} == expected
+
+# Daemon
+def test_serve_address_parses_host_port_and_socket_paths(tmp_path):
+    assert idc_helper.parse_serve_address("127.0.0.1:8787") == ("127.0.0.1", 8787)
+    assert idc_helper.parse_serve_address("localhost:0") == ("localhost", 0)
+    assert idc_helper.parse_serve_address(str(tmp_path / "idc_helper.sock")) == str(tmp_path / "idc_helper.sock")
+    for address in ("8787", "localhost", "idc_helper.db", "localhost:http"):
+        with pytest.raises(ValueError, match="HOST:PORT"):
+            idc_helper.parse_serve_address(address)
+
+def test_serve_address_only_replaces_a_stale_socket(tmp_path):
+    store = tmp_path / "idc_helper.db"
+    store.write_text("data")
+    with pytest.raises(ValueError, match="not a Unix socket"):
+        idc_helper.parse_serve_address(str(store))
+    assert store.read_text() == "data"
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(str(tmp_path / "idc_helper.sock"))
+    stale.close()
+    assert idc_helper.parse_serve_address(str(tmp_path / "idc_helper.sock")) == str(tmp_path / "idc_helper.sock")
+    assert not (tmp_path / "idc_helper.sock").exists()
+
+# Checkpoints
+def test_resumed_list_entitlements_matches_clean_run(backend, tmp_path):
+    clean = run(str(tmp_path / "clean.db"), "list-entitlements")
+
+    ## Fail part way through the assignments with an error that isn't retried, then run the command again.
+    call, calls = backend.call, []
+    def failing_call(operation):
+        call(operation)
+        if operation == "list_account_assignments":
+            calls.append(operation)
+            if len(calls) == 50:
+                raise botocore.exceptions.ClientError({"Error": {"Code": "ExpiredTokenException", "Message": "expired"}}, operation)
+    backend.call = failing_call
+    with pytest.raises(botocore.exceptions.ClientError):
+        run(str(tmp_path / "resumed.db"), "list-entitlements")
+    backend.call = call
+
+    backend.reset_calls()
+    assert run(str(tmp_path / "resumed.db"), "list-entitlements") == clean
+    assert backend.calls["list_account_assignments"] < len(clean[1])
+
+# Shards
+@pytest.mark.parametrize("shard_by", ["permission-set", "account"])
+def test_merged_shards_match_single_process_crawl(backend, tmp_path, shard_by):
+    single = str(tmp_path / "single.db")
+    run(single, "refresh")
+    paths = []
+    for index in range(3):
+        paths.append(str(tmp_path / f"shard{index}.db"))
+        run(paths[-1], "refresh", shard=idc_helper.parse_shard(f"{index}/3", shard_by))
+    merged = str(tmp_path / "merged.db")
+    run(merged, "merge", ",".join(reversed(paths)), offline=True)
+    for command, option in [("list-entitlements", None), ("get-users-for-accounts", "all"), ("list-group-members", None)]:
+        assert run(merged, command, option, offline=True) == run(single, command, option, offline=True)
+
+def test_merge_refuses_an_incomplete_set_of_shards(backend, tmp_path):
+    paths = [str(tmp_path / f"shard{index}.db") for index in range(2)]
+    run(paths[0], "refresh", shard=idc_helper.parse_shard("0/3", "permission-set"))
+    run(paths[1], "refresh", shard=idc_helper.parse_shard("1/3", "permission-set"))
+    with pytest.raises(Exception, match="Shards 2 of 3 are missing"):
+        run(str(tmp_path / "merged.db"), "merge", ",".join(paths), offline=True)
+
+# Policy index
+def test_action_table_matches_iam_wildcards():
+    table = idc_helper.ActionTable()
+    for pattern in ["iam:PassRole", "s3:*", "*", "*:Describe*", "ec2:Get?nstance*"]:
+        table.add(pattern, pattern)
+    table.add_not(["iam:*", "organizations:*"], "NotAction")
+    assert sorted(table.match("IAM:passrole")) == sorted(["iam:PassRole", "*"])
+    assert sorted(table.match("s3:GetObject")) == sorted(["s3:*", "*", "NotAction"])
+    assert sorted(table.match("ec2:DescribeInstances")) == sorted(["*", "*:Describe*", "NotAction"])
+    assert sorted(table.match("ec2:GetInstanceUefiData")) == sorted(["*", "ec2:Get?nstance*", "NotAction"])
+    assert sorted(table.match("ec2:GetXXnstance")) == sorted(["*", "NotAction"])
+    assert sorted(table.match("organizations:ListAccounts")) == ["*"]
+
+def test_policy_index_applies_not_action_and_deny():
+    policies = {
+        "ps-admin": {"inline": None, "managed": [{"Name": "AdministratorAccess", "Arn": "admin"}], "customer_managed": []},
+        "ps-power": {"inline": None, "managed": [{"Name": "PowerUserAccess", "Arn": "power"}], "customer_managed": []},
+        "ps-denied": {"inline": {"Statement": [
+            {"Effect": "Allow", "Action": "iam:*", "Resource": "*"},
+            {"Effect": "Deny", "Action": "iam:PassRole", "Resource": "*"},
+        ]}, "managed": [], "customer_managed": []},
+        "ps-conditional-deny": {"inline": {"Statement": [
+            {"Effect": "Allow", "Action": "iam:PassRole", "Resource": "*"},
+            {"Effect": "Deny", "Action": "iam:*", "Resource": "*", "Condition": {"Bool": {"aws:MultiFactorAuthPresent": "false"}}},
+        ]}, "managed": [], "customer_managed": []},
+        "ps-customer": {"inline": None, "managed": [], "customer_managed": [{"Name": "boundary", "Path": "/"}]},
+    }
+    managed = {
+        "admin": {"Statement": [{"Effect": "Allow", "Action": "*", "Resource": "*"}]},
+        "power": {"Statement": [{"Effect": "Allow", "NotAction": ["iam:*", "organizations:*"], "Resource": "*"}]},
+    }
+    index = idc_helper.PolicyIndex(policies, managed)
+    effects = lambda action: {arn: sorted(grant["effect"] for grant in grants) for arn, grants in index.permission_sets_for_action(action).items()}
+    assert effects("iam:PassRole") == {"ps-admin": ["Allow"], "ps-conditional-deny": ["Allow", "Deny"], "ps-customer": ["Unknown"]}
+    assert effects("iam:GetRole") == {"ps-admin": ["Allow"], "ps-denied": ["Allow"], "ps-customer": ["Unknown"]}
+    assert effects("s3:GetObject") == {"ps-admin": ["Allow"], "ps-power": ["Allow"], "ps-customer": ["Unknown"]}
+
+def test_policy_index_matches_brute_force(backend):
+    index = idc_helper.IdcHelper(None).policy_index()
+    def matches(pattern, action):
+        return re.fullmatch(re.escape(pattern).replace(r"\*", ".*").replace(r"\?", "."), action, re.IGNORECASE)
+    def evaluate(arn, action):
+        documents = [backend.inline_policies[arn]] if arn in backend.inline_policies else []
+        documents += [{"Statement": backend.MANAGED_POLICIES[name]} for name in backend.managed_policy_attachments[arn]]
+        allowed = denied = False
+        for document in documents:
+            for statement in document["Statement"]:
+                if "Action" in statement:
+                    actions = statement["Action"] if isinstance(statement["Action"], list) else [statement["Action"]]
+                    hit = any(matches(pattern, action) for pattern in actions)
+                else:
+                    hit = not any(matches(pattern, action) for pattern in statement["NotAction"])
+                allowed |= hit and statement["Effect"] == "Allow"
+                denied |= hit and statement["Effect"] == "Deny" and statement["Resource"] == "*" and "Condition" not in statement
+        return allowed and not denied, arn in backend.customer_managed_policy_references and not denied
+    for action in ["iam:PassRole", "IAM:CreateUser", "s3:GetObject", "s3:DeleteBucket", "ec2:DescribeInstances", "organizations:ListAccounts", "dynamodb:Query", "sqs:SendMessage"]:
+        grants = index.permission_sets_for_action(action)
+        for arn in backend.permission_sets:
+            effects = {grant["effect"] for grant in grants.get(arn, [])}
+            assert ("Allow" in effects, "Unknown" in effects) == evaluate(arn, action), (arn, action)